@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Oblio and Trendyol clients of main.py, plus the Trendyol calls it makes
+
+The clients are created on first use from the .env settings (see config.py):
+one pooled keep-alive session per API host, reused by every request of
+the run. The Oblio token is cached on disk and refreshed before it expires.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+from config import get_config
+from oblio_auth import OblioTokenCache, OblioBearerAuth, OblioAuthError
+
+# Trendyol caps the page size of the shipment packages listing at 200
+ORDERS_PAGE_SIZE = 200
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name, create):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = create()
+        return _clients[name]
+
+
+def get_oblio_token_cache():
+    config = get_config()
+    return _get_client("oblio_token", lambda: OblioTokenCache(config.client_id, config.client_secret))
+
+
+def get_oblio():
+    """Shared Oblio client (the bearer token is attached and refreshed by it)"""
+    token_cache = get_oblio_token_cache()
+    return _get_client("oblio", lambda: http_client.oblio_client(auth=OblioBearerAuth(token_cache)))
+
+
+def get_trendyol():
+    """Shared Trendyol client (User-Agent, accept and basic auth come from its defaults)"""
+    config = get_config()
+    return _get_client("trendyol", lambda: http_client.trendyol_client(config.seller_id, config.api_key,
+                                                                       config.api_secret))
+
+
+def get_oblio_token():
+    """Make sure we hold a valid Oblio token (from the cache when possible)"""
+    try:
+        return get_oblio_token_cache().get_token()
+    except OblioAuthError as e:
+        print(e)
+        return None
+
+
+def fetch_orders_page(page, size=ORDERS_PAGE_SIZE, extra_params=None):
+    """Fetch a single page of shipment packages from Trendyol"""
+    path = f"/integration/order/sellers/{get_config().seller_id}/orders"
+    params = {
+        "page": page,
+        "size": size,
+        **(extra_params or {})
+    }
+
+    response = get_trendyol().request("GET", path, params=params)
+    if response.status_code != 200:
+        print(response.status_code)
+        print(response.text)
+        exit(f"Exiting ... Eroare get trendyol orders (page {page})")
+
+    return response
+
+
+def iter_trendyol_orders(size=ORDERS_PAGE_SIZE, extra_params=None, first_page=None):
+    """Yield Trendyol orders across all pages, downloading the next page while the current one is processed
+
+    first_page can be passed when page 0 was already fetched (e.g. concurrently with the Oblio auth).
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 0
+        future = None if first_page is not None else executor.submit(fetch_orders_page, page, size, extra_params)
+
+        while page == 0 or future is not None:
+            response = first_page if page == 0 and first_page is not None else future.result()
+            data = response.json()
+            total_pages = data.get("totalPages", 1)
+
+            # Prefetch only one page ahead so memory stays bounded to two pages
+            next_page = page + 1
+            future = executor.submit(fetch_orders_page, next_page, size, extra_params) if next_page < total_pages else None
+
+            print(f"Success: Get trendyol orders (page {page + 1}/{total_pages})")
+
+            # Keep the first page on disk for the offline test scripts
+            if page == 0:
+                with open("orders.json", "w", encoding="utf-8") as f:
+                    f.write(response.text)
+
+            yield from data["content"]
+            page = next_page
+
+
+def iter_modified_orders(params, size=ORDERS_PAGE_SIZE, first_page=None):
+    """Yield the orders matching the sync params (oldest modification first), paging by modification time
+
+    Every page after the first asks for the packages modified since the last
+    one it has seen, instead of using a page offset: posting an invoice link
+    bumps a package's lastModifiedDate, so offset pages shift while we are
+    still paging and orders would be skipped. params must contain endDate,
+    which keeps the bumped packages out of this run.
+
+    Packages modified at the last instant of a full page are held back until
+    the next page returns them, so nothing at the instant being paged is
+    linked (and moved) yet. A full page modified at one instant is the only
+    case that needs an offset, which stays stable for the same reason.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start_date, page = params.get("startDate"), 0
+        # Packages of full pages modified at a single instant, yielded once we are past that instant
+        held = []
+        future = None if first_page is not None else executor.submit(fetch_orders_page, page, size, params)
+        response = first_page
+        pages = 0
+
+        while True:
+            if response is None:
+                response = future.result()
+            content = response.json()["content"]
+            pages += 1
+            print(f"Success: Get trendyol orders (page {pages}, {len(content)} packages)")
+
+            # Keep the first page on disk for the offline test scripts
+            if pages == 1:
+                with open("orders.json", "w", encoding="utf-8") as f:
+                    f.write(response.text)
+
+            # Ask for the next page right away, so it downloads while this one is processed
+            future = None
+            if len(content) >= size:
+                last_modified = content[-1]["lastModifiedDate"]
+                if content[0]["lastModifiedDate"] == last_modified:
+                    # A whole page modified at the same instant: only an offset can move past it
+                    if last_modified != start_date:
+                        start_date, page = last_modified, 0
+                    page += 1
+                    held.extend(content)
+                    orders = []
+                else:
+                    orders = held + [order for order in content if order["lastModifiedDate"] < last_modified]
+                    held = []
+                    start_date, page = last_modified, 0
+                future = executor.submit(fetch_orders_page, page, size, dict(params, startDate=start_date))
+            else:
+                orders = held + content
+
+            yield from orders
+            if future is None:
+                return
+            response = None
+
+
+def send_invoice_link_to_trendyol(shipment_package_id, invoice_link):
+    """Attach the Oblio invoice link to the Trendyol shipment package; returns the response"""
+    print(invoice_link)
+
+    trendyol = get_trendyol()
+    send_invoice_link_url = f"/integration/sellers/{get_config().seller_id}/seller-invoice-links"
+    print(trendyol.url(send_invoice_link_url))
+
+    send_invoice_link_payload = {
+        "invoiceLink": invoice_link,
+        "shipmentPackageId": int(shipment_package_id)
+    }
+
+    res3 = trendyol.request("POST", send_invoice_link_url, json=send_invoice_link_payload)
+    print(f"Send invoice link trendyol response status code: {res3.status_code}")
+    if res3.status_code == 201:
+        print("Success: Send invoice link to trendyol")
+    else:
+        exit(" ====> Error sending invoice link to trendyol !!! <====")
+
+    print(res3.text)
+    return res3
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+"""
+argparse argument types shared by the command line scripts
+"""
+import argparse
+from datetime import date
+
+
+def parse_date(value):
+    """A YYYY-MM-DD day, as the ISO string the state database compares timestamps with"""
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date (expected YYYY-MM-DD): {value}")
@@ -1,48 +1,404 @@
 import os
+import re
+import sys
+import math
+import hashlib
+import argparse
+import tempfile
+from io import BytesIO
 from pathlib import Path
-from PyPDF2 import PdfMerger
+from concurrent.futures import ProcessPoolExecutor
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject
+from state_store import PdfBundles, DownloadLog
+from cli_args import parse_date
+import invoice_archive
 
-def combine_pdfs_in_folder(folder_path):
-    """Combine all PDF files in a folder into one PDF."""
+# Bundles of an invoice selection go to invoice_bundles/<selection>/
+BUNDLES_FOLDER = "invoice_bundles"
+# "N 0 obj ... endobj" framing plus the xref entry written around every object (shared ones too)
+OBJECT_OVERHEAD_BYTES = 40
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def remap_references(obj, shared):
+    """Point references to duplicate objects at the copy that is kept"""
+    if isinstance(obj, IndirectObject):
+        if obj.idnum in shared:
+            return IndirectObject(shared[obj.idnum], 0, obj.pdf)
+        return obj
+    if isinstance(obj, DictionaryObject):
+        for key, value in obj.items():
+            obj[key] = remap_references(value, shared)
+    elif isinstance(obj, ArrayObject):
+        for i, value in enumerate(obj):
+            obj[i] = remap_references(value, shared)
+    return obj
+
+def share_identical_objects(writer, first_idnum, object_hashes):
+    """Replace objects added since first_idnum that are identical to an earlier one by a reference to it
+    
+    Every Oblio invoice embeds the same fonts and logo, so the merged PDF keeps
+    one copy of each. Repeats until nothing changes, because a font dictionary
+    only becomes identical once its font file has been shared. Returns the
+    number of shared objects and the serialized size of the new objects kept.
+    """
+    # PyPDF2 has no public API for this; duplicates become `null` so object numbers stay valid
+    objects = writer._objects
+    shared = {}
+    sizes = {}
+    changed = True
+    while changed:
+        changed = False
+        for idnum in range(first_idnum, len(objects) + 1):
+            if idnum in shared:
+                continue
+            obj = remap_references(objects[idnum - 1], shared)
+            serialized = BytesIO()
+            obj.write_to_stream(serialized, None)
+            sizes[idnum] = serialized.tell() + OBJECT_OVERHEAD_BYTES
+            if isinstance(obj, DictionaryObject) and obj.get("/Type") in ("/Page", "/Pages"):
+                continue
+            canonical = object_hashes.setdefault(hashlib.sha256(serialized.getvalue()).digest(), idnum)
+            if canonical != idnum:
+                shared[idnum] = canonical
+                changed = True
+    for idnum in shared:
+        objects[idnum - 1] = NullObject()
+    kept_bytes = sum(size for idnum, size in sizes.items() if idnum not in shared)
+    return len(shared), kept_bytes + len(shared) * (len(b"null") + OBJECT_OVERHEAD_BYTES)
+
+def get_peak_memory_mb(children=False):
+    """Peak resident memory of this process (or of its largest finished worker) in MB, None where unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def add_pdf(writer, pdf_file, object_hashes):
+    """Copy the pages of pdf_file into writer and share its duplicate objects
+
+    Returns the number of pages, shared objects and bytes added.
+    """
+    first_idnum = len(writer._objects) + 1
+    with open(pdf_file, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            writer.add_page(page)
+        pages = len(reader.pages)
+        # Forget the reader's object mapping: a later reader could reuse its id()
+        writer.reset_translation(reader)
+    shared_objects, added_bytes = share_identical_objects(writer, first_idnum, object_hashes)
+    return pages, shared_objects, added_bytes
+
+def write_pdf(writer, output_filename):
+    """Write to a temporary file and rename, so a crash never leaves a truncated bundle"""
+    tmp_filename = f"{output_filename}.tmp"
+    with open(tmp_filename, 'wb') as output_file:
+        writer.write(output_file)
+    os.replace(tmp_filename, output_filename)
+
+def get_bundle_filename(folder, pdf_files):
+    """Bundles are named after the first and last file they contain"""
+    return Path(folder) / f"{Path(pdf_files[0]).stem}-{Path(pdf_files[-1]).stem}.pdf"
+
+def get_concatenated_filename(folder, pdf_files):
+    """The file of all the bundled PDFs gets an _all suffix, so it never takes the name of a recorded bundle"""
+    return Path(folder) / f"{Path(pdf_files[0]).stem}-{Path(pdf_files[-1]).stem}_all.pdf"
+
+def merge_pdfs(pdf_files, output_filename):
+    """Merge pdf_files into output_filename one file at a time
+    
+    Each input is closed as soon as its pages are copied and its duplicate
+    objects are shared, so memory holds the unique objects only instead of
+    every input file. Returns the number of pages and shared objects.
+    """
+    writer = PdfWriter()
+    object_hashes = {}
+    pages = 0
+    shared_objects = 0
+    for pdf_file in pdf_files:
+        added_pages, added_shared, _ = add_pdf(writer, pdf_file, object_hashes)
+        pages += added_pages
+        shared_objects += added_shared
+    write_pdf(writer, output_filename)
+    return pages, shared_objects
+
+def merge_chunk(pdf_files, output_folder, max_mb=None):
+    """Merge a run of consecutive PDFs into output_folder (runs in a worker process)
+
+    A new volume is started once the current one reaches max_mb, so a volume
+    exceeds the cap by at most one invoice. Returns (filename, pages, shared
+    objects, files) for each volume written.
+    """
+    volumes = []
+    volume_files = []
+    for pdf_file in pdf_files:
+        if not volume_files:
+            writer, object_hashes, pages, shared_objects, size = PdfWriter(), {}, 0, 0, 0
+        added_pages, added_shared, added_bytes = add_pdf(writer, pdf_file, object_hashes)
+        volume_files.append(pdf_file)
+        pages += added_pages
+        shared_objects += added_shared
+        size += added_bytes
+        if max_mb and size >= max_mb * 1024 * 1024:
+            output_filename = get_bundle_filename(output_folder, volume_files)
+            write_pdf(writer, output_filename)
+            volumes.append((output_filename, pages, shared_objects, volume_files))
+            volume_files = []
+    if volume_files:
+        output_filename = get_bundle_filename(output_folder, volume_files)
+        write_pdf(writer, output_filename)
+        volumes.append((output_filename, pages, shared_objects, volume_files))
+    return volumes
+
+def count_pages(pdf_file):
+    with open(pdf_file, "rb") as f:
+        return len(PdfReader(f).pages)
+
+def plan_chunks(pdf_files, page_counts, max_pages):
+    """Split the sorted files into consecutive runs of at most max_pages pages (at least one file each)"""
+    chunks = []
+    chunk_pages = 0
+    for pdf_file, pages in zip(pdf_files, page_counts):
+        if not chunks or chunk_pages + pages > max_pages:
+            chunks.append([])
+            chunk_pages = 0
+        chunks[-1].append(pdf_file)
+        chunk_pages += pages
+    return chunks
+
+def merge_into_bundles(pdf_files, folder, max_pages=None, max_mb=None, workers=None):
+    """Merge pdf_files in parallel chunks into folder; returns (filename, pages, files) per bundle written
+    
+    Without a cap the chunks are joined into a single {first}-{last}.pdf; with
+    one they are kept as numbered volumes.
+    """
+    keep_volumes = bool(max_pages or max_mb)
+    workers = workers or os.cpu_count() or 1
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor, tempfile.TemporaryDirectory(dir=folder) as tmp_folder:
+        page_counts = list(executor.map(count_pages, pdf_files, chunksize=max(1, len(pdf_files) // (workers * 4))))
+        total_pages = sum(page_counts)
+        # Without a page cap, split evenly so every worker gets one chunk
+        chunks = plan_chunks(pdf_files, page_counts, max_pages or math.ceil(total_pages / workers))
+        print(f"Merging {total_pages} pages in {len(chunks)} chunks with up to {workers} workers")
+        
+        futures = [executor.submit(merge_chunk, chunk, folder if keep_volumes else tmp_folder, max_mb)
+                   for chunk in chunks]
+        volumes = [volume for future in futures for volume in future.result()]
+        shared_objects = sum(volume_shared for _, _, volume_shared, _ in volumes)
+        
+        if keep_volumes:
+            bundles = [(volume_filename, volume_pages, volume_files)
+                       for volume_filename, volume_pages, _, volume_files in volumes]
+            for number, (volume_filename, volume_pages, _) in enumerate(bundles, 1):
+                print(f"  Volume {number}/{len(bundles)}: {volume_filename.name} ({volume_pages} pages, "
+                      f"{os.path.getsize(volume_filename) / (1024 * 1024):.1f} MB)")
+        else:
+            # Write the combined PDF
+            output_filename = get_bundle_filename(folder, pdf_files)
+            if len(volumes) == 1:
+                os.replace(volumes[0][0], output_filename)
+            else:
+                _, concatenated_shared = merge_pdfs([volume_filename for volume_filename, _, _, _ in volumes],
+                                                    output_filename)
+                shared_objects += concatenated_shared
+            bundles = [(output_filename, total_pages, pdf_files)]
+            print(f"✓ Combined PDF saved as: {output_filename}")
+    
+    summary = f"  {total_pages} pages in {len(bundles)} file(s), {shared_objects} duplicate objects shared"
+    peak_memory = get_peak_memory_mb()
+    worker_peak_memory = get_peak_memory_mb(children=True)
+    if peak_memory is not None:
+        summary += f", peak memory {peak_memory:.0f} MB (largest worker {worker_peak_memory:.0f} MB)"
+    print(summary)
+    return bundles
+
+def natural_sort_key(pdf_file):
+    """Sort key that compares the numbers in a file name numerically (..._9999 before ..._10000)"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", Path(pdf_file).name)]
+
+def combine_files(pdf_files, output_folder, max_pages=None, max_mb=None, workers=None, concatenate=False,
+                  rebuild=False, file_keys=None):
+    """Bundle the files (in the given order) that are not in a bundle of output_folder yet.
+    
+    The bundles written to each output folder are recorded in the state database,
+    so later runs only merge the files added (or changed) since into a new
+    delta bundle. Files are identified by name unless file_keys maps them to
+    another unique key. concatenate also writes one {first}-{last}_all.pdf of all
+    the files, in order; rebuild deletes the recorded bundles and bundles everything again.
+    """
+    file_keys = file_keys or {pdf_file: pdf_file.name for pdf_file in pdf_files}
+    
+    # Only files that are not in an existing bundle (or changed since) need merging
+    folder_key = str(Path(output_folder).resolve())
+    pdf_bundles = PdfBundles()
+    if rebuild:
+        # The old bundles go too, or they would sit next to the new ones holding the same invoices
+        for bundle_path in pdf_bundles.forget_folder(folder_key):
+            if os.path.exists(bundle_path):
+                print(f"🗑️  Removing old bundle {Path(bundle_path).name}")
+                os.remove(bundle_path)
+    bundled_files = pdf_bundles.bundled_files(folder_key)
+    file_stats = {}
+    for pdf_file in pdf_files:
+        stat = pdf_file.stat()
+        file_stats[pdf_file] = (stat.st_size, stat.st_mtime_ns)
+    
+    # A bundle holding a file that changed since is outdated: drop it and bundle its files again
+    stale_bundles = {bundled_files[file_keys[pdf_file]][0] for pdf_file in pdf_files
+                     if file_keys[pdf_file] in bundled_files
+                     and bundled_files[file_keys[pdf_file]][1:] != file_stats[pdf_file]}
+    for bundle_path in sorted(stale_bundles):
+        print(f"🔄 Files in {Path(bundle_path).name} changed, bundling them again")
+        pdf_bundles.forget_bundle(bundle_path)
+        os.remove(bundle_path)
+    if stale_bundles:
+        bundled_files = pdf_bundles.bundled_files(folder_key)
+    new_files = [pdf_file for pdf_file in pdf_files if file_keys[pdf_file] not in bundled_files]
+    
+    if new_files:
+        if bundled_files:
+            print(f"{len(pdf_files) - len(new_files)} files are already bundled, "
+                  f"bundling {len(new_files)} new or changed ones")
+        for bundle_filename, bundle_pages, bundle_files in merge_into_bundles(new_files, output_folder, max_pages,
+                                                                              max_mb, workers):
+            pdf_bundles.add(folder_key, str(bundle_filename), bundle_pages,
+                            [(file_keys[pdf_file], *file_stats[pdf_file]) for pdf_file in bundle_files])
+    else:
+        print("✓ Every PDF is already in a bundle")
+    
+    bundle_paths = sorted(pdf_bundles.bundles(folder_key), key=natural_sort_key)
+    if concatenate and len(bundle_paths) > 1:
+        # Merged from the files rather than the bundles, so delta bundles don't put their pages out of order
+        output_filename = get_concatenated_filename(output_folder, pdf_files)
+        merge_pdfs(pdf_files, output_filename)
+        print(f"✓ Combined the {len(pdf_files)} PDFs of {len(bundle_paths)} bundles into: {output_filename}")
+    print()
+
+def combine_pdfs_in_folder(folder_path, max_pages=None, max_mb=None, workers=None, concatenate=False, rebuild=False):
+    """Bundle the PDF files of a folder that are not in a bundle yet (see combine_files)."""
     folder = Path(folder_path)
     
     if not folder.exists() or not folder.is_dir():
         print(f"Folder {folder_path} does not exist or is not a directory")
         return
     
-    # Get all PDF files in the folder, sorted by name
-    pdf_files = sorted(folder.glob("*.pdf"))
+    # Get all PDF files in the folder in invoice number order (skipping bundles combined earlier: first-last.pdf)
+    pdf_files = sorted((pdf_file for pdf_file in folder.glob("*.pdf") if "-" not in pdf_file.stem),
+                       key=natural_sort_key)
     
     if not pdf_files:
         print(f"No PDF files found in {folder_path}")
         return
     
     print(f"Found {len(pdf_files)} PDF files in {folder_path}")
+    combine_files(pdf_files, folder, max_pages, max_mb, workers, concatenate, rebuild)
+
+def get_selection_label(series_names=None, first_number=None, last_number=None, start_date=None, end_date=None,
+                        country_code=None):
+    """Folder name describing a selection, e.g. AAA_4001-4500_2026-09-01_2026-09-30_RO"""
+    parts = ["+".join(series_names)] if series_names else []
+    if first_number is not None or last_number is not None:
+        parts.append(f"{first_number or ''}-{last_number or ''}")
+    if start_date or end_date:
+        parts.append(f"{start_date or 'start'}_{end_date or 'now'}")
+    if country_code:
+        parts.append(country_code)
+    return "_".join(parts) or "all"
+
+def combine_selected_invoices(output_folder=None, series_names=None, first_number=None, last_number=None,
+                              start_date=None, end_date=None, country_code=None, **combine_options):
+    """Bundle the downloaded invoices matching a selection, in series and invoice number order
     
-    # Create a PdfMerger object
-    merger = PdfMerger()
-    
-    # Add each PDF to the merger
-    for pdf_file in pdf_files:
-        print(f"  Adding: {pdf_file.name}")
-        merger.append(str(pdf_file))
+    The files are resolved from the invoice ledger and the download log (no
+    folder globbing), so any period can be bundled straight from the archive.
+    """
+    invoices = DownloadLog().select_invoices(series_names, first_number, last_number, start_date, end_date,
+                                             country_code)
+    output_folder = Path(output_folder or Path(BUNDLES_FOLDER) / get_selection_label(
+        series_names, first_number, last_number, start_date, end_date, country_code))
     
-    # Extract invoice numbers from first and last PDF filenames
-    first_invoice = pdf_files[0].stem  # filename without extension
-    last_invoice = pdf_files[-1].stem
+    pdf_files = []
+    file_keys = {}
+    missing = 0
+    for invoice in invoices:
+        pdf_file = Path(invoice_archive.resolve(invoice["archive_path"]))
+        if not pdf_file.exists():
+            missing += 1
+            continue
+        pdf_files.append(pdf_file)
+        file_keys[pdf_file] = invoice["archive_path"]
     
-    # Create output filename with invoice range
-    output_filename = folder / f"{first_invoice}-{last_invoice}.pdf"
+    print(f"Selected {len(invoices)} downloaded invoices")
+    if missing:
+        print(f"⚠️  {missing} selected invoices are missing from {invoice_archive.ARCHIVE_FOLDER} - run download_invoices.py")
+    if not pdf_files:
+        print("No PDF files to combine")
+        return
     
-    # Write the combined PDF
-    with open(output_filename, 'wb') as output_file:
-        merger.write(output_file)
+    os.makedirs(output_folder, exist_ok=True)
+    print(f"Bundling into {output_folder}")
+    combine_files(pdf_files, output_folder, file_keys=file_keys, **combine_options)
+
+def parse_number_range(value):
+    """'4001-4500', '4001-' or '-4500' -> (first, last) with None for an open end"""
+    first, _, last = value.partition("-")
+    try:
+        return (int(first) if first else None), (int(last) if last else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid invoice number range: {value}")
+
+def parse_args():
+    """Command line options for combining PDFs"""
+    parser = argparse.ArgumentParser(description="Combine downloaded invoice PDFs into bundles")
+    parser.add_argument("folder", nargs="?",
+                        help="folder to combine (default: the most recent downloaded_invoices folder)")
+    parser.add_argument("--max-pages", type=int, help="start a new volume after this many pages")
+    parser.add_argument("--max-mb", type=float, help="start a new volume once it reaches this many megabytes")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes merging chunks in parallel (default: number of CPUs)")
+    parser.add_argument("--concatenate", action="store_true",
+                        help="also write a single {first}-{last}_all.pdf of all the bundled PDFs, in order")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="delete the bundles made earlier and bundle the whole folder again")
     
-    merger.close()
-    print(f"✓ Combined PDF saved as: {output_filename}\n")
+    selection = parser.add_argument_group("invoice selection",
+                                          "bundle downloaded invoices from the archive instead of a folder")
+    selection.add_argument("--series", action="append", help="invoice series (repeat for several)")
+    selection.add_argument("--numbers", type=parse_number_range, metavar="FIRST-LAST",
+                           help="invoice number range, either end may be left open (e.g. 4001-4500, 4001-)")
+    selection.add_argument("--from", dest="start_date", type=parse_date, metavar="YYYY-MM-DD",
+                           help="invoices issued on or after this day")
+    selection.add_argument("--to", dest="end_date", type=parse_date, metavar="YYYY-MM-DD",
+                           help="invoices issued on or before this day")
+    selection.add_argument("--country", help="customer country code (e.g. RO)")
+    selection.add_argument("--output", help=f"output folder (default: {BUNDLES_FOLDER}/<selection>)")
+    return parser.parse_args()
 
 def main():
-    """Find the most recent downloaded_invoices folder and combine PDFs."""
+    """Combine the selected invoices, the given folder or the most recent downloaded_invoices folder."""
+    args = parse_args()
+    combine_options = dict(max_pages=args.max_pages, max_mb=args.max_mb, workers=args.workers,
+                           concatenate=args.concatenate, rebuild=args.rebuild)
+    
+    if args.series or args.numbers or args.start_date or args.end_date or args.country:
+        first_number, last_number = args.numbers or (None, None)
+        combine_selected_invoices(args.output, args.series, first_number, last_number, args.start_date,
+                                  args.end_date, args.country, **combine_options)
+        print("Done!")
+        return
+    
+    if args.folder:
+        combine_pdfs_in_folder(args.folder, **combine_options)
+        print("Done!")
+        return
+    
     current_dir = Path(".")
     
     # Find all folders that start with "downloaded_invoices"
@@ -57,7 +413,7 @@ def main():
     most_recent_folder = sorted(invoice_folders)[-1]
     
     print(f"Processing most recent folder: {most_recent_folder.name}\n")
-    combine_pdfs_in_folder(most_recent_folder)
+    combine_pdfs_in_folder(most_recent_folder, **combine_options)
     
     print("Done!")
 
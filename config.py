@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Credentials and account settings of the integration, read from .env
+
+Nothing is read at import time: get_config() loads .env the first time it
+is called, so modules that only need the order transforms can be imported
+without a .env file.
+"""
+import os
+import threading
+from dotenv import load_dotenv
+
+
+class Config:
+    """Trendyol seller and Oblio account settings"""
+
+    def __init__(self, seller_id, api_key, api_secret, cif, client_id, client_secret):
+        self.seller_id = seller_id
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.cif = cif
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+    @classmethod
+    def from_env(cls):
+        load_dotenv()
+        return cls(
+            seller_id=os.getenv("SELLER_ID"),
+            api_key=os.getenv("API_KEY"),
+            api_secret=os.getenv("API_SECRET"),
+            cif=os.getenv("CIF"),
+            client_id=os.getenv("CLIENT_ID"),
+            client_secret=os.getenv("CLIENT_SECRET"),
+        )
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """The settings of this run, loaded from .env on first use"""
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = Config.from_env()
+        return _config
@@ -1,241 +1,342 @@
 #!/usr/bin/env python3
 """
-Script to download all invoice files from invoice_links.json
+Script to download all invoice files recorded in the invoice ledger
 Avoids duplicates by checking existing files and tracking downloaded invoices
+
+Files are stored once in the invoice archive (see invoice_archive.py); the
+downloaded_invoices_YYYY-MM-DD folder of the day is generated as a view.
 """
-import json
 import requests
 import os
+import hashlib
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
-import time
+import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import http_client
+import rate_limit
+from state_store import InvoiceLedger, DownloadLog
+import invoice_archive
 
-def create_downloads_folder():
-    """Create downloads folder with current date"""
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    downloads_folder = f"downloaded_invoices_{current_date}"
-    if not os.path.exists(downloads_folder):
-        os.makedirs(downloads_folder)
-        print(f"📁 Created folder: {downloads_folder}")
-    return downloads_folder
+# Downloads are streamed to disk in chunks of this size, so memory stays flat
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 def get_filename_from_invoice_number(invoice_number):
     """Generate filename based on invoice number only"""
-    filename = f"Trendyol_Factura_{invoice_number}.pdf"
-    return filename
+    return invoice_archive.get_filename(invoice_number)
 
-def filter_latest_invoices(invoice_data):
-    """Keep only the latest invoice for each invoice number"""
-    # Group invoices by invoice number
-    invoice_groups = {}
-    
-    for invoice in invoice_data:
-        invoice_number = invoice.get("invoice_number", "unknown")
-        timestamp = invoice.get("timestamp", "")
-        
-        if invoice_number not in invoice_groups:
-            invoice_groups[invoice_number] = invoice
+def finish_archive(download_log, day):
+    """Commit the log, regenerate the archive manifest and the dated view for `day`"""
+    download_log.flush()
+    downloads = download_log.all()
+    manifest_entries = invoice_archive.write_manifest(downloads)
+    view_folder = invoice_archive.build_date_view(downloads, day)
+    print(f"🧾 Manifest: {manifest_entries} invoices in {invoice_archive.ARCHIVE_FOLDER}/{invoice_archive.MANIFEST_FILE}")
+    return view_folder
+
+def format_number_ranges(invoice_numbers, max_ranges=5):
+    """Compact '1-40, 42, 45-50' summary of a set of invoice numbers"""
+    numbers = sorted(int(number) for number in invoice_numbers if str(number).isdigit())
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
         else:
-            # Compare timestamps and keep the latest one
-            if timestamp > invoice_groups[invoice_number].get("timestamp", ""):
-                print(f"🔄 Replacing older invoice {invoice_number} with newer version")
-                invoice_groups[invoice_number] = invoice
-            else:
-                print(f"⏭️  Skipping older version of invoice {invoice_number}")
-    
-    return list(invoice_groups.values())
+            ranges.append([number, number])
+    parts = [str(first) if first == last else f"{first}-{last}" for first, last in ranges[:max_ranges]]
+    if len(ranges) > max_ranges:
+        parts.append(f"... ({len(ranges) - max_ranges} more ranges)")
+    return ", ".join(parts)
 
-def load_downloaded_log():
-    """Load the log of already downloaded files"""
-    log_file = "downloaded_invoices_log.json"
+def file_sha256(file_path):
+    """SHA-256 and size of a file already on disk, read in chunks"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+def parse_content_range_total(content_range):
+    """Total size from a 'bytes start-end/total' Content-Range header, or None"""
     try:
-        with open(log_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+        total = content_range.rsplit("/", 1)[1]
+        return None if total == "*" else int(total)
+    except (AttributeError, IndexError, ValueError):
+        return None
 
-def get_last_downloaded_invoice_number(downloaded_log):
-    """Get the highest invoice number that was downloaded"""
-    if not downloaded_log:
-        return 0
-    
-    max_invoice_number = 0
-    for entry in downloaded_log:
-        try:
-            invoice_number = int(entry.get("invoice_number", "0"))
-            max_invoice_number = max(max_invoice_number, invoice_number)
-        except (ValueError, TypeError):
-            continue
-    
-    return max_invoice_number
+def download_invoice(invoice_link, filename, downloads_folder, validators=None, save_validators=None, revalidate=False):
+    """Download a single invoice file
 
-def filter_new_invoices(filtered_invoices, last_downloaded_number):
-    """Filter invoices to only include those newer than the last downloaded"""
-    if last_downloaded_number == 0:
-        return filtered_invoices
-    
-    new_invoices = []
-    for invoice in filtered_invoices:
-        try:
-            invoice_number = int(invoice.get("invoice_number", "0"))
-            if invoice_number > last_downloaded_number:
-                new_invoices.append(invoice)
-        except (ValueError, TypeError):
-            # If invoice number is not a valid integer, include it to be safe
-            new_invoices.append(invoice)
-    
-    return new_invoices
+    The body is streamed into <filename>.part and only renamed to the final
+    name once it is complete and flushed, so a crash never leaves a truncated
+    PDF that looks finished.
 
-def save_downloaded_log(downloaded_log):
-    """Save the log of downloaded files"""
-    log_file = "downloaded_invoices_log.json"
-    with open(log_file, "w", encoding="utf-8") as f:
-        json.dump(downloaded_log, f, indent=2, ensure_ascii=False)
+    validators are the ETag/Last-Modified seen on an earlier attempt. They are
+    used to resume a leftover .part file with a Range request, or (with
+    revalidate=True, for a file that is already on disk) to send a conditional
+    GET that a 304 answers without transferring the file. save_validators is
+    called with the new validators as soon as the response headers arrive.
 
-def download_invoice(invoice_link, filename, downloads_folder):
-    """Download a single invoice file"""
+    Returns {"status", "sha256", "size"} on success, None on failure.
+    """
+    file_path = os.path.join(downloads_folder, filename)
+    part_path = f"{file_path}.part"
+    validators = validators or {}
+    validator = validators.get("etag") or validators.get("last_modified")
     try:
-        print(f"⬇️  Downloading: {filename}")
-        
         # Add headers to mimic a browser request
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
         
-        response = requests.get(invoice_link, headers=headers, timeout=30)
-        response.raise_for_status()
+        resume_from = 0
+        if revalidate:
+            print(f"🔎 Revalidating: {filename}")
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        elif validator and os.path.exists(part_path) and os.path.getsize(part_path) > 0:
+            # Only resume if the file is still the one we started (If-Range falls back to a full 200)
+            resume_from = os.path.getsize(part_path)
+            headers["Range"] = f"bytes={resume_from}-"
+            headers["If-Range"] = validator
+            print(f"⏯️  Resuming: {filename} from byte {resume_from}")
+        else:
+            print(f"⬇️  Downloading: {filename}")
+        
+        with http_client.request("GET", invoice_link, headers=headers, timeout=30, stream=True) as response:
+            if response.status_code == 304:
+                sha256, size = file_sha256(file_path)
+                print(f"✅ Not modified: {filename}")
+                return {"status": "not_modified", "sha256": sha256, "size": size}
+            
+            if response.status_code == 416 and resume_from:
+                # Nothing left to send from that offset: the .part file is either complete (a crash
+                # between the fsync and the rename) or longer than the file on the server now
+                if validators.get("content_length") and int(validators["content_length"]) == resume_from:
+                    sha256, size = file_sha256(part_path)
+                    os.replace(part_path, file_path)
+                    print(f"✅ Completed: {filename} ({size} bytes were already downloaded)")
+                    return {"status": "resumed", "sha256": sha256, "size": size}
+                print(f"🔁 Discarding {part_path} (the server can't resume it), downloading again")
+                response.close()
+                os.remove(part_path)
+                return download_invoice(invoice_link, filename, downloads_folder, save_validators=save_validators)
+            
+            response.raise_for_status()
+            
+            if save_validators:
+                save_validators({
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "content_length": (parse_content_range_total(response.headers.get("Content-Range"))
+                                       if response.status_code == 206 else response.headers.get("Content-Length"))
+                })
+            
+            # Stream to the temp file, hashing as we go (a resumed download re-hashes the bytes it already has)
+            sha256 = hashlib.sha256()
+            size = 0
+            if response.status_code == 206:
+                mode = "ab"
+                expected_size = parse_content_range_total(response.headers.get("Content-Range"))
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        sha256.update(chunk)
+                        size += len(chunk)
+            else:
+                mode = "wb"
+                expected_size = response.headers.get("Content-Length")
+            
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            if expected_size and "Content-Encoding" not in response.headers and int(expected_size) != size:
+                raise IOError(f"incomplete download ({size} of {expected_size} bytes)")
         
-        # Save the file
-        file_path = os.path.join(downloads_folder, filename)
-        with open(file_path, "wb") as f:
-            f.write(response.content)
+        # Atomic on the same filesystem: the final name only ever points to a complete file
+        os.replace(part_path, file_path)
         
-        print(f"✅ Downloaded: {filename} ({len(response.content)} bytes)")
-        return True
+        status = "resumed" if response.status_code == 206 else "downloaded"
+        print(f"✅ Downloaded: {filename} ({size} bytes{', resumed' if status == 'resumed' else ''})")
+        return {"status": status, "sha256": sha256.hexdigest(), "size": size}
         
     except requests.exceptions.RequestException as e:
         print(f"❌ Failed to download {filename}: {e}")
-        return False
+        return None
     except Exception as e:
         print(f"❌ Error downloading {filename}: {e}")
-        return False
+        return None
+
+def parse_args():
+    """Command line options for the downloader"""
+    parser = argparse.ArgumentParser(description="Download invoice PDFs recorded in the invoice ledger")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="maximum number of downloads in flight (default: 4)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="maximum requests per second to each invoice host (default: rate_limit default)")
+    parser.add_argument("--view", metavar="YYYY-MM-DD",
+                        help="only (re)build the downloaded_invoices_YYYY-MM-DD view for that day and exit")
+    return parser.parse_args()
 
 def main():
     """Main function to download all invoices"""
-    print("🚀 Starting invoice download process...")
+    args = parse_args()
     
-    # Load invoice links
-    try:
-        with open("invoice_links.json", "r", encoding="utf-8") as f:
-            invoice_data = json.load(f)
-    except FileNotFoundError:
-        print("❌ invoice_links.json not found!")
-        return
-    except json.JSONDecodeError:
-        print("❌ Error reading invoice_links.json!")
-        return
+    # Load download log (the old dated folders are imported into the archive once)
+    download_log = DownloadLog()
+    # Log writes are committed in batches; make sure the last one lands even if the run is interrupted
+    atexit.register(download_log.flush)
+    invoice_archive.import_legacy_folders(download_log)
     
-    if not invoice_data:
-        print("📭 No invoice links found in the file.")
+    if args.view:
+        print(f"📁 View ready: {finish_archive(download_log, args.view)}")
         return
     
-    # Filter to keep only the latest invoice for each invoice number
-    print(f"📊 Found {len(invoice_data)} total invoice links")
-    filtered_invoices = filter_latest_invoices(invoice_data)
-    print(f"📋 After filtering duplicates: {len(filtered_invoices)} unique invoices")
+    print("🚀 Starting invoice download process...")
     
-    # Create downloads folder
-    downloads_folder = create_downloads_folder()
+    # Load invoice links
+    invoice_count = InvoiceLedger().count()
+    
+    if not invoice_count:
+        print("📭 No invoice links found in the invoice ledger.")
+        return
     
-    # Load download log and find last downloaded invoice
-    downloaded_log = load_downloaded_log()
-    last_downloaded_number = get_last_downloaded_invoice_number(downloaded_log)
+    print(f"📊 Found {invoice_count} total invoice links")
     
-    if last_downloaded_number > 0:
-        print(f"🔍 Last downloaded invoice: {last_downloaded_number}")
-        # Filter to only include invoices newer than the last downloaded
-        new_invoices = filter_new_invoices(filtered_invoices, last_downloaded_number)
-        print(f"📋 New invoices to download: {len(new_invoices)} (invoice numbers > {last_downloaded_number})")
-        filtered_invoices = new_invoices
+    # What is already downloaded, per series
+    downloaded = download_log.downloaded_invoice_numbers()
+    if downloaded:
+        for series_name, invoice_numbers in sorted(downloaded.items()):
+            print(f"🔍 Downloaded {series_name or '(no series)'}: {len(invoice_numbers)} invoices "
+                  f"({format_number_ranges(invoice_numbers)})")
     else:
         print("📋 No previous downloads found - will download all invoices")
     
+    # Latest version of every invoice that is not in the download index, including late lower numbers
+    filtered_invoices = download_log.pending_invoices()
+    print(f"📋 New invoices to download: {len(filtered_invoices)}")
+    
     if not filtered_invoices:
         print("✅ All invoices are already downloaded!")
+        finish_archive(download_log, datetime.now().strftime("%Y-%m-%d"))
         return
     
-    downloaded_invoice_numbers = {entry.get("invoice_number") for entry in downloaded_log}
-    
     # Process each invoice
     new_downloads = 0
     skipped_duplicates = 0
     failed_downloads = 0
+    to_download = []
     
+    # First pass: dedup against the archive folder, collect what really needs downloading
     for i, invoice in enumerate(filtered_invoices, 1):
         invoice_link = invoice.get("invoice_link", "")
         order_id = invoice.get("order_id", "unknown")
         invoice_number = invoice.get("invoice_number", "unknown")
+        series_name = invoice.get("series_name") or ""
         
-        print(f"\n[{i}/{len(filtered_invoices)}] Processing Order {order_id}, Invoice {invoice_number}")
-        
-        # Check if invoice number already downloaded
-        if invoice_number in downloaded_invoice_numbers:
-            print(f"⏭️  Invoice {invoice_number} already downloaded - skipping")
-            skipped_duplicates += 1
-            continue
+        print(f"\n[{i}/{len(filtered_invoices)}] Processing Order {order_id}, Invoice {series_name} {invoice_number}")
         
-        # Generate filename
+        # Generate filename; every invoice has a single fixed place in the archive
         filename = get_filename_from_invoice_number(invoice_number)
-        file_path = os.path.join(downloads_folder, filename)
+        archive_path = invoice_archive.get_archive_path(invoice_number, series_name)
+        file_path = invoice_archive.resolve(archive_path)
+        
+        validators = download_log.get_validators(invoice_number, series_name)
         
         # Check if file already exists (additional safety check)
         if os.path.exists(file_path):
+            if validators.get("etag") or validators.get("last_modified"):
+                # We know its validators: a conditional GET confirms it without re-downloading
+                to_download.append((invoice, archive_path, validators, True))
+                continue
             print(f"📁 File already exists - skipping")
-            # Add to log if not already there
-            if invoice_number not in downloaded_invoice_numbers:
-                downloaded_log.append({
-                    "timestamp": datetime.now().isoformat(),
-                    "order_id": order_id,
-                    "invoice_number": invoice_number,
-                    "invoice_link": invoice_link,
-                    "filename": filename,
-                    "status": "already_existed"
-                })
-                downloaded_invoice_numbers.add(invoice_number)
-            skipped_duplicates += 1
-            continue
-        
-        # Download the file
-        success = download_invoice(invoice_link, filename, downloads_folder)
-        
-        if success:
-            # Add to download log
-            downloaded_log.append({
+            sha256, size = file_sha256(file_path)
+            # Add to log (we only get here if it is not already there)
+            download_log.add({
                 "timestamp": datetime.now().isoformat(),
                 "order_id": order_id,
+                "series_name": series_name,
                 "invoice_number": invoice_number,
                 "invoice_link": invoice_link,
                 "filename": filename,
-                "status": "downloaded"
+                "status": "already_existed",
+                "sha256": sha256,
+                "size": size,
+                "archive_path": archive_path
             })
-            downloaded_invoice_numbers.add(invoice_number)
-            new_downloads += 1
+            skipped_duplicates += 1
+            continue
+        
+        to_download.append((invoice, archive_path, validators, False))
+    
+    # Second pass: download in parallel; the per-host rate limiter keeps us respectful to the server
+    if args.rate:
+        for host in {urlparse(invoice.get("invoice_link", "")).netloc for invoice, *_ in to_download}:
+            rate_limit.set_rate(f"https://{host}", args.rate)
+    
+    if to_download:
+        print(f"\n⬇️  Downloading {len(to_download)} invoices with up to {args.workers} in flight...")
+    
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {}
+        for invoice, archive_path, validators, revalidate in to_download:
+            file_path = invoice_archive.resolve(archive_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            invoice_link = invoice.get("invoice_link", "")
+            invoice_number = invoice.get("invoice_number", "unknown")
+            series_name = invoice.get("series_name") or ""
             
-            # Save log after each successful download
-            save_downloaded_log(downloaded_log)
+            def save_validators(new_validators, invoice_number=invoice_number, series_name=series_name,
+                                invoice_link=invoice_link):
+                download_log.save_validators(invoice_number, series_name, invoice_link, new_validators)
             
-        else:
-            failed_downloads += 1
+            future = executor.submit(download_invoice, invoice_link, os.path.basename(file_path),
+                                     os.path.dirname(file_path), validators, save_validators, revalidate)
+            futures[future] = (invoice, archive_path)
         
-        # Small delay to be respectful to the server
-        time.sleep(1)
+        # Log updates happen here, on the main thread, as each download finishes
+        for future in as_completed(futures):
+            invoice, archive_path = futures[future]
+            
+            result = future.result()
+            if result:
+                # Add to download log (committed immediately)
+                download_log.add({
+                    "timestamp": datetime.now().isoformat(),
+                    "order_id": invoice.get("order_id", "unknown"),
+                    "series_name": invoice.get("series_name") or "",
+                    "invoice_number": invoice.get("invoice_number", "unknown"),
+                    "invoice_link": invoice.get("invoice_link", ""),
+                    "filename": os.path.basename(archive_path),
+                    "status": "already_existed" if result["status"] == "not_modified" else "downloaded",
+                    "sha256": result["sha256"],
+                    "size": result["size"],
+                    "archive_path": archive_path
+                })
+                if result["status"] == "not_modified":
+                    skipped_duplicates += 1
+                else:
+                    new_downloads += 1
+            else:
+                failed_downloads += 1
+    
+    view_folder = finish_archive(download_log, datetime.now().strftime("%Y-%m-%d"))
     
     # Final summary
     print(f"\n🎉 Download process completed!")
     print(f"📥 New downloads: {new_downloads}")
     print(f"⏭️  Skipped duplicates: {skipped_duplicates}")
     print(f"❌ Failed downloads: {failed_downloads}")
-    print(f"📁 Files saved in: {downloads_folder}")
+    print(f"📁 Files saved in: {invoice_archive.ARCHIVE_FOLDER} (today's view: {view_folder})")
     
     if failed_downloads > 0:
         print(f"\n⚠️  {failed_downloads} downloads failed. You can run this script again to retry.")
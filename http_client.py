@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP clients used by main.py, download_invoices.py and sendspv.py
+
+Each ApiClient wraps one pooled, keep-alive requests.Session with its own
+default headers/auth, transport-level retries and the per-API rate
+limiter. AsyncHttpClient runs those blocking calls on worker threads so
+independent requests can overlap inside an event loop.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from rate_limit import throttle
+
+DEFAULT_TIMEOUT = 60
+
+OBLIO_API_URL = "https://www.oblio.eu"
+TRENDYOL_API_URL = "https://apigw.trendyol.com"
+
+
+class RetryPolicy:
+    """Retry throttled responses, honouring Retry-After and backing off exponentially with jitter
+
+    Only statuses in retry_statuses are retried (by default just 429, which means the
+    request was rejected before being processed, so it is safe even for POSTs).
+    """
+
+    def __init__(self, max_attempts=6, base_delay=1.0, max_delay=60.0, max_total_delay=180.0,
+                 retry_statuses=(429,)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_delay = max_total_delay
+        self.retry_statuses = retry_statuses
+
+    def get_server_delay(self, response):
+        """Seconds the server asked us to wait, from Retry-After or X-RateLimit-Reset, or None"""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+        reset = response.headers.get("X-RateLimit-Reset")
+        if reset:
+            try:
+                reset = float(reset)
+            except ValueError:
+                return None
+            # Either seconds until reset or an epoch timestamp
+            return max(0.0, reset - time.time()) if reset > 1e9 else reset
+
+        return None
+
+    def get_delay(self, response, attempt):
+        """Delay before retry number `attempt` (1-based)
+
+        A delay asked for by the server is never shortened (coming back earlier
+        only earns another 429); max_delay caps our own backoff, and the
+        request gives up instead when the wait would pass max_total_delay.
+        """
+        server_delay = self.get_server_delay(response)
+        if server_delay is not None:
+            # Small jitter so parallel workers don't all come back at the same instant
+            return server_delay + random.uniform(0, self.base_delay)
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def get_concurrency():
+    """Maximum number of requests in flight (and pooled connections per host), from HTTP_CONCURRENCY"""
+    return int(os.getenv("HTTP_CONCURRENCY", "10"))
+
+
+class ApiClient:
+    """A pooled session bound to one API: base URL, default headers and auth"""
+
+    def __init__(self, base_url="", headers=None, auth=None, pool_size=None, retry_policy=DEFAULT_RETRY_POLICY,
+                 api=None):
+        self.base_url = base_url.rstrip("/")
+        # Name of the rate limit bucket shared by all requests to this API (None: per host)
+        self.api = api
+        self.retry_policy = retry_policy
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.session.auth = auth
+
+        # Retry connection errors and gateway failures on idempotent methods only;
+        # POSTs (invoice creation) must never be replayed blindly at this level
+        retries = Retry(total=3, connect=3, read=2, backoff_factor=0.5,
+                        status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or get_concurrency(), max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        """Resolve a path against the base URL (absolute URLs are used as is)"""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}{path}"
+
+    def request(self, method, path, retry_policy=None, **kwargs):
+        """Send a request, waiting for a slot on the rate limiter of the API (or host) first
+
+        Throttled responses are retried according to the retry policy; once it gives
+        up the last response is returned so the caller can decide what to do.
+        """
+        url = self.url(path)
+        policy = retry_policy or self.retry_policy
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+
+        total_delay = 0.0
+        attempt = 1
+        while True:
+            throttle(url, self.api)
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code not in policy.retry_statuses or attempt >= policy.max_attempts:
+                return response
+
+            delay = policy.get_delay(response, attempt)
+            if total_delay + delay > policy.max_total_delay:
+                return response
+
+            print(f"⏳ {response.status_code} from {urlparse(url).netloc}, retrying in {delay:.1f}s "
+                  f"(attempt {attempt}/{policy.max_attempts - 1})")
+            # Release the connection of the throttled response (matters for stream=True)
+            response.close()
+            time.sleep(delay)
+            total_delay += delay
+            attempt += 1
+
+
+def oblio_client(auth=None):
+    """Client for the Oblio API (OBLIO_API_URL can point it at another server)
+
+    Pass an oblio_auth.OblioBearerAuth to have the access token attached to every request.
+    """
+    return ApiClient(os.getenv("OBLIO_API_URL", OBLIO_API_URL), auth=auth, api="oblio")
+
+
+def trendyol_client(seller_id, api_key, api_secret):
+    """Client for the Trendyol integration API with the SelfIntegration User-Agent and basic auth"""
+    headers = {
+        "User-Agent": f"{seller_id} - SelfIntegration",
+        "accept": "application/json"
+    }
+    return ApiClient(os.getenv("TRENDYOL_API_URL", TRENDYOL_API_URL), headers=headers,
+                     auth=HTTPBasicAuth(api_key, api_secret), api="trendyol")
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    """Client without a base URL, for absolute links such as invoice PDFs"""
+    global _default_client
+    # Download workers make their first requests at the same time; they must all get the same pooled session
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ApiClient()
+        return _default_client
+
+
+def request(method, url, **kwargs):
+    """Drop-in replacement for requests.request() using the shared session and rate limits"""
+    return get_default_client().request(method, url, **kwargs)
+
+
+class AsyncHttpClient:
+    """asyncio front end for ApiClient.request() with bounded concurrency"""
+
+    def __init__(self, concurrency=None):
+        self.semaphore = asyncio.Semaphore(concurrency or get_concurrency())
+
+    async def call(self, func, *args, **kwargs):
+        """Run a blocking function (typically one doing HTTP calls) on a worker thread"""
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+
+def call_all(*funcs, concurrency=None):
+    """Synchronous helper: run independent zero-argument functions concurrently, returning results in order"""
+    async def run():
+        client = AsyncHttpClient(concurrency)
+        return await asyncio.gather(*(client.call(func) for func in funcs))
+    return asyncio.run(run())
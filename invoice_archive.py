@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Single archive of downloaded invoice PDFs, keyed by series and invoice number
+
+Every invoice has exactly one location:
+
+    invoice_archive/<series>/<number // 1000>/Trendyol_Factura_<number>.pdf
+
+so "do we already have it?" is a lookup in the download log and re-runs
+never store a second copy. MANIFEST.sha256 (sha256sum format) is generated
+from the download log. The old per-day downloaded_invoices_YYYY-MM-DD
+folders are now views: hard links (copies where links are not supported)
+to the invoices downloaded on that day.
+"""
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+ARCHIVE_FOLDER = "invoice_archive"
+MANIFEST_FILE = "MANIFEST.sha256"
+DATE_VIEW_PREFIX = "downloaded_invoices_"
+# Invoices whose series is unknown (imported from the old JSON files)
+UNKNOWN_SERIES = "_"
+
+
+def get_filename(invoice_number):
+    """Generate filename based on invoice number only"""
+    return f"Trendyol_Factura_{invoice_number}.pdf"
+
+
+def get_archive_path(invoice_number, series_name=""):
+    """Path of an invoice inside the archive, relative to ARCHIVE_FOLDER"""
+    try:
+        shard = f"{int(invoice_number) // 1000:03d}"
+    except (TypeError, ValueError):
+        shard = "other"
+    return os.path.join(series_name or UNKNOWN_SERIES, shard, get_filename(invoice_number))
+
+
+def resolve(archive_path):
+    """Absolute location of an archive-relative path"""
+    return os.path.join(ARCHIVE_FOLDER, archive_path)
+
+
+def link_or_copy(source, destination):
+    """Hard link source to destination, copying when the filesystem can't link"""
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def write_manifest(downloads):
+    """Regenerate MANIFEST.sha256 from the download log (written to a temp file, then atomically replaced)"""
+    manifest_path = os.path.join(ARCHIVE_FOLDER, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.tmp"
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    entries = sorted((entry["archive_path"], entry["sha256"]) for entry in downloads
+                     if entry.get("archive_path") and entry.get("sha256"))
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for archive_path, sha256 in entries:
+            f.write(f"{sha256}  {Path(archive_path).as_posix()}\n")
+    os.replace(tmp_path, manifest_path)
+    return len(entries)
+
+
+def build_date_view(downloads, day):
+    """Populate downloaded_invoices_<day> with the invoices downloaded on that day; returns the folder"""
+    view_folder = f"{DATE_VIEW_PREFIX}{day}"
+    linked = 0
+    for entry in downloads:
+        if not (entry.get("archive_path") and (entry.get("timestamp") or "").startswith(day)):
+            continue
+        source = resolve(entry["archive_path"])
+        destination = os.path.join(view_folder, os.path.basename(entry["archive_path"]))
+        if os.path.exists(destination) and os.path.exists(source) and not os.path.samefile(source, destination):
+            # Same number in another series: prefix the series to keep both
+            destination = os.path.join(view_folder, f"{entry.get('series_name') or UNKNOWN_SERIES}_"
+                                                    f"{os.path.basename(entry['archive_path'])}")
+        if os.path.exists(source) and not os.path.exists(destination):
+            link_or_copy(source, destination)
+            linked += 1
+    if linked:
+        print(f"📁 Added {linked} invoices to view {view_folder}")
+    return view_folder
+
+
+def import_legacy_folders(download_log):
+    """Move invoices from the old per-day folders into the archive (once)
+
+    Files are hard linked into the archive, so the old folders keep working
+    as views and no extra disk space is used.
+    """
+    if download_log.get_meta("migrated:date_folders"):
+        return
+
+    imported = 0
+    for folder in sorted(Path(".").glob(f"{DATE_VIEW_PREFIX}*")):
+        if not folder.is_dir():
+            continue
+        for pdf_file in folder.glob("Trendyol_Factura_*.pdf"):
+            invoice_number = pdf_file.stem[len("Trendyol_Factura_"):]
+            if "-" in invoice_number:
+                # A combined bundle (first-last.pdf), not a single invoice
+                continue
+            series_name = download_log.get_series(invoice_number)
+            archive_path = get_archive_path(invoice_number, series_name)
+            if not os.path.exists(resolve(archive_path)):
+                link_or_copy(str(pdf_file), resolve(archive_path))
+                imported += 1
+            download_log.set_archive_path(invoice_number, series_name, archive_path)
+
+    download_log.set_meta("migrated:date_folders", datetime.now().isoformat())
+    download_log.flush()
+    if imported:
+        print(f"📦 Imported {imported} invoices from the dated folders into {ARCHIVE_FOLDER}")
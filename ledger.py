@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Local records of main.py: issued invoices, cancelled orders and the sync cursor
+
+The invoice ledger and cancelled orders live in integration_state.db (see
+state_store.py) and are opened on first use; the sync cursor is kept in
+sync_state.json.
+"""
+import atexit
+import json
+import os
+import threading
+from datetime import datetime
+from order_transforms import build_cancelled_order
+from state_store import InvoiceLedger, CancelledOrders
+
+# Incremental sync: modification time (ms since epoch) up to which every package was processed
+SYNC_STATE_FILE = "sync_state.json"
+# Re-read a few minutes before the cursor so late-committed changes are not missed
+SYNC_OVERLAP_MINUTES = 10
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_invoice_ledger():
+    with _stores_lock:
+        if "invoices" not in _stores:
+            _stores["invoices"] = InvoiceLedger()
+        return _stores["invoices"]
+
+
+def get_cancelled_orders():
+    with _stores_lock:
+        if "cancelled_orders" not in _stores:
+            _stores["cancelled_orders"] = CancelledOrders()
+            # Queued cancellations are also written if the run stops early on exit()
+            atexit.register(_stores["cancelled_orders"].flush)
+        return _stores["cancelled_orders"]
+
+
+def save_invoice_link(order_id, invoice_link, invoice_number, total_amount, series_name=None, currency=None,
+                      country_code=None):
+    """Append the invoice link with order details to the invoice ledger (one committed row, no file rewrite)"""
+    get_invoice_ledger().add(order_id, invoice_link, invoice_number, total_amount,
+                             series_name=series_name, currency=currency, country_code=country_code)
+
+    print(f"Saved invoice link for order {order_id}: {invoice_link}")
+
+
+def save_cancelled_order(order, reason):
+    """Save cancelled order information to the state database"""
+    cancelled_orders = get_cancelled_orders()
+    order_id = order.get("id", "Unknown")
+
+    # Check if order ID already exists (indexed lookup)
+    if cancelled_orders.exists(order_id):
+        print(f"🔄 Order {order_id} already recorded as cancelled - skipping duplicate")
+        return
+
+    # Queue the new cancelled order; all of them are written in one go at the end of the run
+    cancelled_orders.add(build_cancelled_order(order, reason))
+
+    print(f"💾 Recorded cancelled order info for order {order_id}")
+
+
+def load_sync_cursor():
+    """Load the last processed package modification timestamp, or None on first sync"""
+    try:
+        with open(SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f).get("last_modified_date")
+    except FileNotFoundError:
+        return None
+
+
+def save_sync_cursor(last_modified_date):
+    """Persist the sync cursor (written to a temp file first so a crash never leaves it half written)"""
+    sync_state = {
+        "last_modified_date": last_modified_date,
+        "last_modified_date_iso": datetime.fromtimestamp(last_modified_date / 1000).isoformat(),
+        "updated_at": datetime.now().isoformat()
+    }
+    tmp_file = f"{SYNC_STATE_FILE}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(sync_state, f, indent=2)
+    os.replace(tmp_file, SYNC_STATE_FILE)
+
+    print(f"💾 Saved sync cursor: {sync_state['last_modified_date_iso']}")
+
+
+def get_sync_params(last_modified_date, end_date):
+    """Build the Trendyol query params asking only for packages changed between the cursor and end_date"""
+    params = {
+        "orderByField": "PackageLastModifiedDate",
+        "orderByDirection": "ASC",
+        "endDate": end_date
+    }
+    if last_modified_date:
+        params["startDate"] = last_modified_date - SYNC_OVERLAP_MINUTES * 60 * 1000
+    return params
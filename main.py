@@ -1,133 +1,74 @@
-import requests
+#!/usr/bin/env python3
+"""
+Issue Oblio invoices for Trendyol orders and send the invoice links back to Trendyol
+
+Command line entry point. The building blocks live in importable modules
+without side effects: config (.env settings), api_clients (Oblio/Trendyol
+clients and calls), order_transforms (order -> invoice data) and ledger
+(local state). process_order, should_skip_order and save_cancelled_order
+are re-exported here for the test scripts.
+"""
 import json
-from dotenv import load_dotenv
-import os
-from requests.auth import HTTPBasicAuth
-from datetime import date, datetime
+from datetime import datetime
 import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import http_client
+from config import get_config
+from api_clients import (get_oblio, get_oblio_token, fetch_orders_page, iter_trendyol_orders,
+                         iter_modified_orders, send_invoice_link_to_trendyol)
+from order_transforms import process_order, should_skip_order, build_invoice_payload
+from ledger import (SYNC_STATE_FILE, SYNC_OVERLAP_MINUTES, get_invoice_ledger, get_cancelled_orders,
+                    save_invoice_link, save_cancelled_order, load_sync_cursor, save_sync_cursor, get_sync_params)
 
+# Guards the shared files when orders are processed by several workers
+file_lock = threading.Lock()
 
-def process_order(order):
-  prod_list = order["lines"]
-  oblio_prod_list = []
-
-  for prod in prod_list:
-    assert not prod["discountDetails"][0]["lineItemTyDiscount"]
-    quantity = prod["quantity"]
-    
-    oblio_prod = {
-        "name": prod["productName"],
-        "code": prod["contentId"],
-        "price": prod["lineGrossAmount"],
-        "measuringUnit": "buc",
-        "vatName": "Normala",
-        "vatPercentage": 21,
-        "vatIncluded": 1,
-        "quantity": quantity,
-        "discountAllAbove": 1
-    }
-
-    #discount_value = prod["discountDetails"][0]["lineItemDiscount"]
-    discount_value = prod["lineTotalDiscount"]
-
-    prod_discount = {
-      "name": "Discount",
-      "discount": discount_value * quantity,
-      "discountType": "valoric"
-    }
-
-    # must first append the prod
-    oblio_prod_list.append(oblio_prod)
-
-    # only after the discount
-    if discount_value:
-      oblio_prod_list.append(prod_discount)
-  
-  return oblio_prod_list
+
+def write_debug_file(filename, text):
+  """Write one of the current_order*.json debug snapshots"""
+  with file_lock:
+    with open(filename, "w", encoding="utf-8") as f:
+      f.write(text)
+
+
+def link_invoice(shipment_package_id, invoice_link):
+  """Send the invoice link to Trendyol and keep its response as a debug snapshot"""
+  res3 = send_invoice_link_to_trendyol(shipment_package_id, invoice_link)
+  write_debug_file("current_order_trendyol_invoice_link_response.json", res3.text)
 
 
 def start_process_order_with_no_invoice_link(order):
+  """Invoice one order and link it on Trendyol; returns False when the order was left for the next run"""
 
-  # 1. Get the product list from your existing process
-  oblio_prod_list = process_order(order)
-
-  # 2. Extract basic address info
-  invoice_address = order["invoiceAddress"]
-  country_code = invoice_address.get("countryCode", "RO") # GR, RO, etc.
-  
-  # Determine Country Name and Business Rules based on country code
-  if country_code == "RO":
-      full_country_name = "Romania"
-      series_name = "AAA"
-      language = "RO"
-      currency = "RON"
-  else:
-      series_name = "EXT"      # Standard series for non-RO
-      language = "EN"
-      currency = order.get("currencyCode", "EUR") # Use the currency from the JSON (EUR)
-      if country_code == "GR":
-        full_country_name = "Greece"
-      if country_code == "BG":
-        full_country_name = "Bulgaria"
-      # Add future countries here
-      assert full_country_name
-
-  # 3. Prepare Client Details
-  client_name = f"{invoice_address['firstName']} {invoice_address['lastName']}"
-  # Clean up address: strip whitespace in case address2 is empty
-  client_adress = f"{invoice_address['address1']} {invoice_address['address2']}".strip()
-  
-  # Use stateName for Greece, fallback to countyName for others
-  state = invoice_address.get("stateName") or invoice_address.get("countyName") or ""
-  city = invoice_address["city"]
-  customer_id = order["customerId"]
-  county_id = invoice_address["countyId"]
-  postal_code = invoice_address["postalCode"]
-
-  # 4. Handle Bucharest sectors (ONLY if it is Romania)
-  if country_code == "RO":
-      if county_id == 12261437:
-          print("Bucharest postal code detected")
-          sector_digit = postal_code[:2]
-          if sector_digit in ["01", "02", "03", "04", "05", "06"]:
-              sector_number = int(sector_digit)
-              city = f"Sector {sector_number}"
-
-  # 5. Construct the final Payload
-  invoice_payload = {
-      "cif": cif,
-      "client": {
-          "name": client_name,
-          "address": client_adress,
-          "state": state,
-          "city": city,
-          "country": full_country_name,
-          "save": 1,
-          "code": customer_id
-      },
-      "seriesName": series_name,
-      "language": language,
-      "currency": currency,
-      "products": oblio_prod_list
-  }
-
-  with open("current_order.json", "w", encoding="utf-8") as f:
-    f.write(json.dumps(invoice_payload))
-    
-  # now we send the data to oblio
-
-  headers = {
-    'Authorization': f"Bearer {response_oblio_auth.json()["access_token"]}"
-  }
-
-  emitere_factura_url = "https://www.oblio.eu/api/docs/invoice"
-
-  res2 = requests.request("POST", emitere_factura_url, headers=headers, json=invoice_payload)
+  # 0. Never issue a second invoice for a package we already invoiced (e.g. the link post failed last run)
+  existing_invoices = get_invoice_ledger().find_by_order(order["shipmentPackageId"])
+  if existing_invoices:
+    existing_invoice = existing_invoices[-1]
+    print(f"🔁 Package {order['shipmentPackageId']} already invoiced ({existing_invoice['invoice_number']}) - only resending the link to trendyol")
+    link_invoice(order["shipmentPackageId"], existing_invoice["invoice_link"])
+    return True
+
+  # 1. Products, client details and series/currency rules of the order
+  invoice_payload = build_invoice_payload(order, get_config().cif)
+  series_name = invoice_payload["seriesName"]
+  currency = invoice_payload["currency"]
+  country_code = order["invoiceAddress"].get("countryCode", "RO")
+
+  write_debug_file("current_order.json", json.dumps(invoice_payload))
+
+  # now we send the data to oblio (the bearer token is attached and refreshed by the oblio client)
+
+  emitere_factura_url = "/api/docs/invoice"
+
+  # 429s are retried by the client's retry policy (Retry-After, exponential backoff)
+  res2 = get_oblio().request("POST", emitere_factura_url, json=invoice_payload)
 
   if res2.status_code == 429:
-    print("Too many requests, sleeping for 60s...")
-    time.sleep(60)
-    res2 = requests.request("POST", emitere_factura_url, headers=headers, json=invoice_payload)
+    # Nothing was issued; main() keeps the sync cursor before this order so the next run picks it up again
+    print(f"⚠️  Still rate limited by Oblio - leaving order {order.get('orderNumber', 'Unknown')} for the next run")
+    return False
 
   if res2.status_code == 200:
     print("Success: Factura emisa")
@@ -138,8 +79,7 @@ def start_process_order_with_no_invoice_link(order):
 
   print(res2.text)
 
-  with open("current_order_oblio_response.json", "w", encoding="utf-8") as f:
-    f.write(res2.text)
+  write_debug_file("current_order_oblio_response.json", res2.text)
 
   # now we send the invoive link to trendyol
 
@@ -151,12 +91,12 @@ def start_process_order_with_no_invoice_link(order):
   # Get Trendyol total price for comparison
   trendyol_total_price = order["packageTotalPrice"]
   oblio_total_price = float(total_amount)
-  
+
   # Price validation check
   print(f"\n=== PRICE VALIDATION ===")
   print(f"Trendyol Total: {trendyol_total_price} f{currency}")
   print(f"Oblio Total: {oblio_total_price} f{currency}")
-  
+
   price_difference = abs(trendyol_total_price - oblio_total_price)
   if price_difference < 0.01:  # Allow for small floating point differences
     print("✅ PRICES MATCH!")
@@ -168,207 +108,117 @@ def start_process_order_with_no_invoice_link(order):
   shipment_package_id = order["shipmentPackageId"]
 
   # Save invoice link to persistent file
-  save_invoice_link(shipment_package_id, invoice_link, invoice_number, total_amount)
-
-  print(invoice_link)
-
-  send_invoice_link_url = f"https://apigw.trendyol.com/integration/sellers/{seller_id}/seller-invoice-links"
-  print(send_invoice_link_url)
-
-  send_invoice_link_payload = {
-    "invoiceLink": invoice_link,
-    "shipmentPackageId": int(shipment_package_id)
-  }
-  headers = {
-  "User-Agent": f'{seller_id} - SelfIntegration',
-  "accept": "application/json",
-  "content-type": "application/json"
-  }
-
-  res3 = requests.request("POST", send_invoice_link_url, headers=headers, json=send_invoice_link_payload, auth=HTTPBasicAuth(api_key, api_secret))
-  print(f"Send invoice link trendyol response status code: {res3.status_code}")
-  if res3.status_code == 201:
-    print("Success: Send invoice link to trendyol")
+  save_invoice_link(shipment_package_id, invoice_link, invoice_number, total_amount,
+                    series_name=oblio_response["data"].get("seriesName", series_name),
+                    currency=currency, country_code=country_code)
+
+  link_invoice(shipment_package_id, invoice_link)
+  return True
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Issue Oblio invoices for Trendyol orders")
+  parser.add_argument("--sync", action="store_true",
+                      help=f"only fetch packages modified since the last run (cursor kept in {SYNC_STATE_FILE})")
+  parser.add_argument("--workers", type=int, default=1,
+                      help="issue invoices for up to N orders in parallel (requests stay within the per-API rate limits)")
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+
+  # Trendyol query for this run
+  orders_params = None
+  sync_cursor = None
+  if args.sync:
+    sync_cursor = load_sync_cursor()
+    # Packages modified after this instant (including the ones we link now) are left for the next run
+    sync_end = int(time.time() * 1000)
+    orders_params = get_sync_params(sync_cursor, sync_end)
+    if sync_cursor:
+      print(f"🔄 Sync mode: fetching packages modified since {datetime.fromtimestamp(sync_cursor / 1000).isoformat()} (-{SYNC_OVERLAP_MINUTES} min overlap)")
+    else:
+      print("🔄 Sync mode: no cursor yet - fetching all packages")
+
+  # Oblio auth and the first page of trendyol orders are independent, so fetch them concurrently
+  access_token, first_orders_page = http_client.call_all(
+    get_oblio_token,
+    lambda: fetch_orders_page(0, extra_params=orders_params)
+  )
+
+  if access_token:
+    print("Success: Oblio auth")
   else:
-    exit(" ====> Error sending invoice link to trendyol !!! <====")
-
-  print(res3.text)
-  with open("current_order_trendyol_invoice_link_response.json", "w", encoding="utf-8") as f:
-    f.write(res3.text)
-
-
-def save_cancelled_order(order, reason):
-  """Save cancelled order information to a persistent file"""
-  order_id = order.get("id", "Unknown")
-  
-  # Load existing cancelled orders or create new list
-  cancelled_orders_file = "cancelled_orders_info.json"
-  try:
-    with open(cancelled_orders_file, "r", encoding="utf-8") as f:
-      cancelled_orders = json.load(f)
-  except FileNotFoundError:
-    cancelled_orders = []
-  
-  # Check if order ID already exists
-  existing_order_ids = [existing_order.get("order_id") for existing_order in cancelled_orders]
-  if order_id in existing_order_ids:
-    print(f"🔄 Order {order_id} already exists in cancelled orders file - skipping duplicate")
-    return
-  
-  cancelled_order_data = {
-    "timestamp": datetime.now().isoformat(),
-    "order_id": order_id,
-    "order_number": order.get("orderNumber", "Unknown"),
-    "cancellation_reason": reason,
-    "total_price": order.get("totalPrice", 0),
-    "gross_amount": order.get("grossAmount", 0),
-    "customer_name": "",
-    "order_date": order.get("orderDate", ""),
-    "lines": []
-  }
-  
-  # Extract customer name from invoice address
-  invoice_address = order.get("invoiceAddress", {})
-  if invoice_address:
-    cancelled_order_data["customer_name"] = f"{invoice_address.get('firstName', '')} {invoice_address.get('lastName', '')}".strip()
-  
-  # Extract product information
-  for line in order.get("lines", []):
-    line_info = {
-      "product_name": line.get("productName", ""),
-      "quantity": line.get("quantity", 0),
-      "price": line.get("price", 0),
-      "amount": line.get("amount", 0),
-      "status": line.get("orderLineItemStatusName", "")
-    }
-    cancelled_order_data["lines"].append(line_info)
-  
-  # Add new cancelled order
-  cancelled_orders.append(cancelled_order_data)
-  
-  # Save back to file
-  with open(cancelled_orders_file, "w", encoding="utf-8") as f:
-    json.dump(cancelled_orders, f, indent=2, ensure_ascii=False)
-  
-  print(f"💾 Saved cancelled order info for order {order_id}")
-
-
-def should_skip_order(order):
-  """Check if order should be skipped based on status"""
-  # Check line item statuses
-  for line in order.get("lines", []):
-    line_status = line.get("orderLineItemStatusName", "")
-    if line_status == "Cancelled":
-      return True, f"Line item status: {line_status}", True  # True indicates it's cancelled
-    elif line_status == "Awaiting":
-      return True, f"Line item status: {line_status}", False  # False indicates it's not cancelled
-  
-  # Check package history for latest status
-  package_histories = order.get("packageHistories", [])
-  if package_histories:
-    # Get the latest status (last item in the list)
-    latest_status = package_histories[-1].get("status", "")
-    if latest_status == "Cancelled":
-      return True, f"Package status: {latest_status}", True  # True indicates it's cancelled
-    elif latest_status == "Awaiting":
-      return True, f"Package status: {latest_status}", False  # False indicates it's not cancelled
-  
-  return False, "", False
-
-
-def save_invoice_link(order_id, invoice_link, invoice_number, total_amount):
-  """Save invoice link to a persistent file with order details"""
-  invoice_data = {
-    "timestamp": datetime.now().isoformat(),
-    "order_id": order_id,
-    "invoice_number": invoice_number,
-    "invoice_link": invoice_link,
-    "total_amount": total_amount
-  }
-  
-  # Load existing invoice links or create new list
-  invoice_links_file = "invoice_links.json"
-  try:
-    with open(invoice_links_file, "r", encoding="utf-8") as f:
-      invoice_links = json.load(f)
-  except FileNotFoundError:
-    invoice_links = []
-  
-  # Add new invoice link
-  invoice_links.append(invoice_data)
-  
-  # Save back to file
-  with open(invoice_links_file, "w", encoding="utf-8") as f:
-    json.dump(invoice_links, f, indent=2, ensure_ascii=False)
-  
-  print(f"Saved invoice link for order {order_id}: {invoice_link}")
-
-########################################### START ###########################################
-
-load_dotenv()
-seller_id = os.getenv("SELLER_ID")
-api_key = os.getenv("API_KEY")
-api_secret = os.getenv("API_SECRET")
-cif = os.getenv("CIF")
-client_id = os.getenv("CLIENT_ID")
-client_secret = os.getenv("CLIENT_SECRET")
-
-# Oblio auth
-url = "https://www.oblio.eu/api/authorize/token"
-payload = f'client_id={client_id}&client_secret={client_secret}'
-headers = {
-  'Content-Type': 'application/x-www-form-urlencoded'
-}
-
-response_oblio_auth = requests.request("POST", url, headers=headers, data=payload)
-
-if response_oblio_auth.status_code == 200:
-  print("Success: Oblio auth")
-else:
-  exit("Oblio auth fail")
-
-print(response_oblio_auth.text)
-
-# Get orders trendyol
-url = f"https://apigw.trendyol.com/integration/order/sellers/{seller_id}/orders?size=200"
-
-headers = {
-  'User-Agent': f'{seller_id} - SelfIntegration',
-}
-
-response = requests.request("GET", url, headers=headers, auth=HTTPBasicAuth(api_key, api_secret))
-if response.status_code == 200:
-  print("Success: Get trendyol orders")
-
-#to file
-with open("orders.json", "w", encoding="utf-8") as f:
-    f.write(response.text)
-
-
-data = response.json()
-content_list = data["content"]
-
-for order in content_list:
-  order_id = order.get("orderNumber", "Unknown")
-  
-  # Check if order should be skipped due to status
-  should_skip, skip_reason, is_cancelled = should_skip_order(order)
-  if should_skip:
-    print(f"⏭️  Skipping order {order_id}: {skip_reason}")
-    
-    # If it's a cancelled order, save the order info
-    if is_cancelled:
-      save_cancelled_order(order, skip_reason)
-    
-    continue
-  
-  if "invoiceLink" not in order.keys():
-    print(f"📋 Processing order {order_id}")
-    
-    start_process_order_with_no_invoice_link(order)
-    #break # we only do 1 at a time for now
-    time.sleep(1)
+    exit("Oblio auth fail")
+
+  # Pipeline mode: each order still goes Oblio issue -> price check -> Trendyol link in order,
+  # but several orders are in flight at once
+  executor = ThreadPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+  in_flight = {}
+  # lastModifiedDate of the orders left for the next run
+  left_for_next_run = []
+
+  def check_processed(order, processed):
+    if not processed:
+      left_for_next_run.append(order.get("lastModifiedDate"))
+
+  # Get orders trendyol, page by page
+  if args.sync:
+    orders = iter_modified_orders(orders_params, first_page=first_orders_page)
   else:
-    print(f"✅ Order {order_id} already has invoice ... Skipping ...")
-  
-    
\ No newline at end of file
+    orders = iter_trendyol_orders(first_page=first_orders_page)
+  for order in orders:
+    order_id = order.get("orderNumber", "Unknown")
+
+    # Check if order should be skipped due to status
+    should_skip, skip_reason, is_cancelled = should_skip_order(order)
+    if should_skip:
+      print(f"⏭️  Skipping order {order_id}: {skip_reason}")
+
+      # If it's a cancelled order, save the order info
+      if is_cancelled:
+        save_cancelled_order(order, skip_reason)
+
+      continue
+
+    if "invoiceLink" not in order.keys():
+      print(f"📋 Processing order {order_id}")
+
+      if executor:
+        # Keep the backlog bounded; result() re-raises any exit() from a worker and stops the run
+        if len(in_flight) >= 2 * args.workers:
+          done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+          for future in done:
+            check_processed(in_flight.pop(future), future.result())
+        in_flight[executor.submit(start_process_order_with_no_invoice_link, order)] = order
+      else:
+        check_processed(order, start_process_order_with_no_invoice_link(order))
+        #break # we only do 1 at a time for now
+        time.sleep(1)
+    else:
+      print(f"✅ Order {order_id} already has invoice ... Skipping ...")
+
+  if executor:
+    for future, order in in_flight.items():
+      check_processed(order, future.result())
+    executor.shutdown()
+
+  saved_cancellations = get_cancelled_orders().flush()
+  if saved_cancellations:
+    print(f"💾 Saved {saved_cancellations} cancelled orders")
+
+  # Every package modified up to the end of the sync window was processed (a failure exits before this),
+  # except the ones left for the next run: the cursor stays at the oldest of those
+  if args.sync:
+    if None in left_for_next_run:
+      print(f"⚠️  {len(left_for_next_run)} orders left for the next run - keeping the previous sync cursor")
+    elif left_for_next_run:
+      print(f"⚠️  {len(left_for_next_run)} orders left for the next run - the cursor stays before them")
+      save_sync_cursor(min(left_for_next_run))
+    else:
+      save_sync_cursor(sync_end)
+
+
+if __name__ == "__main__":
+  main()
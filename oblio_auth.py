@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Cached Oblio access token shared by main.py and sendspv.py
+
+The token is kept in .oblio_token.json together with its expiry, so short
+runs reuse it without an auth round trip and long runs refresh it shortly
+before it expires. A lock file serialises refreshes between processes.
+"""
+import json
+import os
+import threading
+import time
+from requests.auth import AuthBase
+import http_client
+
+TOKEN_CACHE_FILE = ".oblio_token.json"
+# Refresh this many seconds before the token actually expires
+REFRESH_MARGIN_SECONDS = 300
+# Oblio tokens are valid for one hour when the response does not say otherwise
+DEFAULT_EXPIRES_IN = 3600
+# A token request may legitimately hold the refresh lock this long: the whole retry budget of
+# the retry policy plus a timeout per attempt. Only older lock files are treated as left by a crash.
+TOKEN_LOCK_STALE_SECONDS = (http_client.DEFAULT_RETRY_POLICY.max_total_delay
+                            + http_client.DEFAULT_RETRY_POLICY.max_attempts * http_client.DEFAULT_TIMEOUT)
+
+
+class OblioAuthError(Exception):
+    """Raised when Oblio refuses to issue an access token"""
+
+
+class FileLock:
+    """Cross-process lock based on exclusively creating a lock file"""
+
+    def __init__(self, path, timeout=30, stale_after=60):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                # A crashed process may have left its lock behind
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale_after:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Could not acquire {self.path}")
+                time.sleep(0.1)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class OblioTokenCache:
+    """Access token for one set of Oblio credentials, cached in memory and on disk"""
+
+    def __init__(self, client_id, client_secret, cache_file=TOKEN_CACHE_FILE):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+        # Plain client without bearer auth, only used for the token endpoint
+        self.client = http_client.oblio_client()
+
+    def _is_fresh(self, expires_at):
+        return expires_at - REFRESH_MARGIN_SECONDS > time.time()
+
+    def _load(self):
+        """Return (token, expires_at) from the cache file if it belongs to our credentials"""
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None, 0
+        if cached.get("client_id") != self.client_id:
+            return None, 0
+        return cached.get("access_token"), cached.get("expires_at", 0)
+
+    def _save(self, token, expires_at):
+        """Write the cache file atomically and readable by the owner only"""
+        tmp_file = f"{self.cache_file}.tmp"
+        fd = os.open(tmp_file, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"client_id": self.client_id, "access_token": token, "expires_at": expires_at}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def _fetch(self):
+        """Request a new token from Oblio"""
+        payload = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'client_credentials'
+        }
+        response = self.client.request("POST", "/api/authorize/token", data=payload)
+        if response.status_code != 200:
+            raise OblioAuthError(f"Oblio auth failed ({response.status_code}): {response.text}")
+
+        token_data = response.json()
+        expires_in = int(token_data.get("expires_in") or DEFAULT_EXPIRES_IN)
+        return token_data["access_token"], time.time() + expires_in
+
+    def get_token(self):
+        """Return a token valid for at least REFRESH_MARGIN_SECONDS, refreshing it if needed"""
+        with self.lock:
+            if self.token and self._is_fresh(self.expires_at):
+                return self.token
+
+            with FileLock(f"{self.cache_file}.lock", timeout=TOKEN_LOCK_STALE_SECONDS + 30,
+                          stale_after=TOKEN_LOCK_STALE_SECONDS):
+                # Another process may have refreshed the token while we waited for the lock
+                token, expires_at = self._load()
+                if not (token and self._is_fresh(expires_at)):
+                    token, expires_at = self._fetch()
+                    self._save(token, expires_at)
+                    print("🔑 Obtained new Oblio access token")
+
+            self.token, self.expires_at = token, expires_at
+            return token
+
+    def invalidate(self, token=None):
+        """Forget the current token, e.g. after Oblio rejected it
+
+        With `token` (the rejected one) nothing happens if the cache already
+        moved on to another token, so concurrent 401s trigger a single refresh.
+        """
+        with self.lock:
+            if token is not None and token != (self.token or self._load()[0]):
+                return
+            self.token, self.expires_at = None, 0
+            try:
+                os.remove(self.cache_file)
+            except FileNotFoundError:
+                pass
+
+
+class OblioBearerAuth(AuthBase):
+    """requests auth that attaches a fresh bearer token from the cache to every request"""
+
+    def __init__(self, token_cache):
+        self.token_cache = token_cache
+
+    def __call__(self, r):
+        r.headers["Authorization"] = f"Bearer {self.token_cache.get_token()}"
+        r.register_hook("response", self.retry_unauthorized)
+        return r
+
+    def retry_unauthorized(self, response, **kwargs):
+        """On a 401 (token revoked or rotated by Oblio) drop the cached token, get a new one and resend once"""
+        if response.status_code != 401 or getattr(response.request, "token_refreshed", False):
+            return response
+
+        rejected_token = response.request.headers.get("Authorization", "").removeprefix("Bearer ")
+        self.token_cache.invalidate(rejected_token)
+        print("🔑 Oblio rejected the cached access token - requesting a new one")
+
+        # Release the connection of the rejected response before reusing it
+        response.content
+        response.close()
+        request = response.request.copy()
+        request.headers["Authorization"] = f"Bearer {self.token_cache.get_token()}"
+        request.token_refreshed = True
+
+        retried = response.connection.send(request, **kwargs)
+        retried.history.append(response)
+        retried.request = request
+        return retried
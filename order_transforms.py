@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Pure transformations of Trendyol shipment packages into Oblio data
+
+No network, files or .env: everything here works on the order dicts from
+the Trendyol API (or orders.json), so test and tooling scripts can import
+it without side effects.
+"""
+from datetime import datetime
+
+# Trendyol county id of Bucharest, whose addresses are invoiced per sector
+BUCHAREST_COUNTY_ID = 12261437
+BUCHAREST_SECTORS = ["01", "02", "03", "04", "05", "06"]
+
+COUNTRY_NAMES = {
+    "RO": "Romania",
+    "GR": "Greece",
+    "BG": "Bulgaria",
+    # Add future countries here
+}
+
+
+def process_order(order):
+    """Oblio product lines (each followed by its discount line, if any) for a Trendyol order"""
+    prod_list = order["lines"]
+    oblio_prod_list = []
+
+    for prod in prod_list:
+        assert not prod["discountDetails"][0]["lineItemTyDiscount"]
+        quantity = prod["quantity"]
+
+        oblio_prod = {
+            "name": prod["productName"],
+            "code": prod["contentId"],
+            "price": prod["lineGrossAmount"],
+            "measuringUnit": "buc",
+            "vatName": "Normala",
+            "vatPercentage": 21,
+            "vatIncluded": 1,
+            "quantity": quantity,
+            "discountAllAbove": 1
+        }
+
+        #discount_value = prod["discountDetails"][0]["lineItemDiscount"]
+        discount_value = prod["lineTotalDiscount"]
+
+        prod_discount = {
+            "name": "Discount",
+            "discount": discount_value * quantity,
+            "discountType": "valoric"
+        }
+
+        # must first append the prod
+        oblio_prod_list.append(oblio_prod)
+
+        # only after the discount
+        if discount_value:
+            oblio_prod_list.append(prod_discount)
+
+    return oblio_prod_list
+
+
+def should_skip_order(order):
+    """Check if order should be skipped based on status"""
+    # Check line item statuses
+    for line in order.get("lines", []):
+        line_status = line.get("orderLineItemStatusName", "")
+        if line_status == "Cancelled":
+            return True, f"Line item status: {line_status}", True  # True indicates it's cancelled
+        elif line_status == "Awaiting":
+            return True, f"Line item status: {line_status}", False  # False indicates it's not cancelled
+
+    # Check package history for latest status
+    package_histories = order.get("packageHistories", [])
+    if package_histories:
+        # Get the latest status (last item in the list)
+        latest_status = package_histories[-1].get("status", "")
+        if latest_status == "Cancelled":
+            return True, f"Package status: {latest_status}", True  # True indicates it's cancelled
+        elif latest_status == "Awaiting":
+            return True, f"Package status: {latest_status}", False  # False indicates it's not cancelled
+
+    return False, "", False
+
+
+def get_invoice_rules(order):
+    """(country_code, country name, series, language, currency) for the invoice of an order"""
+    country_code = order["invoiceAddress"].get("countryCode", "RO") # GR, RO, etc.
+    full_country_name = COUNTRY_NAMES.get(country_code)
+    assert full_country_name, f"No invoicing rules for country {country_code}"
+
+    if country_code == "RO":
+        return country_code, full_country_name, "AAA", "RO", "RON"
+    # Standard series for non-RO, in the currency from the order (EUR)
+    return country_code, full_country_name, "EXT", "EN", order.get("currencyCode", "EUR")
+
+
+def get_client_city(invoice_address, country_code):
+    """City for the invoice; Bucharest addresses get their sector ("Sector N") from the postal code"""
+    city = invoice_address["city"]
+    if country_code == "RO" and invoice_address["countyId"] == BUCHAREST_COUNTY_ID:
+        print("Bucharest postal code detected")
+        sector_digit = invoice_address["postalCode"][:2]
+        if sector_digit in BUCHAREST_SECTORS:
+            city = f"Sector {int(sector_digit)}"
+    return city
+
+
+def build_invoice_payload(order, cif):
+    """Oblio /api/docs/invoice payload for a Trendyol order"""
+    invoice_address = order["invoiceAddress"]
+    country_code, full_country_name, series_name, language, currency = get_invoice_rules(order)
+
+    # Clean up address: strip whitespace in case address2 is empty
+    client_adress = f"{invoice_address['address1']} {invoice_address['address2']}".strip()
+
+    return {
+        "cif": cif,
+        "client": {
+            "name": f"{invoice_address['firstName']} {invoice_address['lastName']}",
+            "address": client_adress,
+            # Use stateName for Greece, fallback to countyName for others
+            "state": invoice_address.get("stateName") or invoice_address.get("countyName") or "",
+            "city": get_client_city(invoice_address, country_code),
+            "country": full_country_name,
+            "save": 1,
+            "code": order["customerId"]
+        },
+        "seriesName": series_name,
+        "language": language,
+        "currency": currency,
+        "products": process_order(order)
+    }
+
+
+def build_cancelled_order(order, reason):
+    """Cancelled order record (as stored in the cancelled_orders table) for a Trendyol order"""
+    cancelled_order_data = {
+        "timestamp": datetime.now().isoformat(),
+        "order_id": order.get("id", "Unknown"),
+        "order_number": order.get("orderNumber", "Unknown"),
+        "cancellation_reason": reason,
+        "total_price": order.get("totalPrice", 0),
+        "gross_amount": order.get("grossAmount", 0),
+        "customer_name": "",
+        "order_date": order.get("orderDate", ""),
+        "lines": []
+    }
+
+    # Extract customer name from invoice address
+    invoice_address = order.get("invoiceAddress", {})
+    if invoice_address:
+        cancelled_order_data["customer_name"] = f"{invoice_address.get('firstName', '')} {invoice_address.get('lastName', '')}".strip()
+
+    # Extract product information
+    for line in order.get("lines", []):
+        line_info = {
+            "product_name": line.get("productName", ""),
+            "quantity": line.get("quantity", 0),
+            "price": line.get("price", 0),
+            "amount": line.get("amount", 0),
+            "status": line.get("orderLineItemStatusName", "")
+        }
+        cancelled_order_data["lines"].append(line_info)
+
+    return cancelled_order_data
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Token bucket rate limiting shared by all threads talking to the same API
+
+Limits are kept per API (the clients in http_client name theirs: "oblio",
+"trendyol"), so they also hold when OBLIO_API_URL/TRENDYOL_API_URL point
+the clients at another server. Other URLs (e.g. invoice PDF links) are
+limited per host; the production hosts of the APIs share the API's bucket.
+"""
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+# Requests per second and burst size for each API (overridable from .env)
+DEFAULT_API_LIMITS = {
+    "oblio": ("OBLIO_REQUESTS_PER_SECOND", 1.0, 5),
+    "trendyol": ("TRENDYOL_REQUESTS_PER_SECOND", 4.0, 10),
+}
+# Requests to these hosts outside the API clients (e.g. PDF links) count against the API's limit
+HOST_APIS = {
+    "www.oblio.eu": "oblio",
+    "apigw.trendyol.com": "trendyol",
+}
+
+# Used for hosts we have no explicit quota for (e.g. invoice PDF links)
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 4
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """Consume `tokens` if available without waiting; returns 0, or the seconds until they will be"""
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, then consume them"""
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limit_key(url, api=None):
+    """The API name, or the host of `url` for requests outside the API clients"""
+    if api:
+        return api
+    host = urlparse(url).netloc
+    return HOST_APIS.get(host, host)
+
+
+def get_limiter(url, api=None):
+    """Return the shared limiter of `api`, or of the host of `url`"""
+    key = get_limit_key(url, api)
+    with _limiters_lock:
+        if key not in _limiters:
+            env_name, rate, burst = DEFAULT_API_LIMITS.get(key, (None, DEFAULT_RATE, DEFAULT_BURST))
+            if env_name and os.getenv(env_name):
+                rate = float(os.getenv(env_name))
+            _limiters[key] = TokenBucket(rate, burst)
+        return _limiters[key]
+
+
+def set_rate(url, rate, burst=None, api=None):
+    """Override the request rate of `api`, or of the host of `url` (e.g. from a command line option)"""
+    key = get_limit_key(url, api)
+    with _limiters_lock:
+        _limiters[key] = TokenBucket(rate, burst or max(1, int(rate)))
+
+
+def throttle(url, api=None):
+    """Wait for a request slot of `api`, or of the host of `url`"""
+    get_limiter(url, api).acquire()
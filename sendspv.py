@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 """
 Script to send invoices to SPV (Sistema de Prelucrare a Facturilor) using Oblio API.
-Usage: python sendspv.py <start_number> <end_number>
+Usage: python sendspv.py [start_number end_number] [--series S] [--from DATE] [--to DATE] [--workers N] [--rate R]
+
+The invoices to send are taken from the local invoice ledger (every series
+main.py issues in), skipping the ones already confirmed as sent to SPV.
 """
 
 import sys
 import os
+import time
 import requests
 import json
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import http_client
+import rate_limit
+from cli_args import parse_date
+from oblio_auth import OblioTokenCache, OblioBearerAuth, OblioAuthError
+from state_store import SpvSubmissions
+
+# Shared keep-alive session for all Oblio calls of the run (created once .env is loaded)
+oblio = None
 
 def load_environment():
     """Load environment variables from .env file"""
@@ -23,23 +38,14 @@ def load_environment():
     
     return cif, client_id, client_secret
 
-def get_access_token(client_id, client_secret):
-    """Get access token from Oblio API"""
-    url = "https://www.oblio.eu/api/authorize/token"
-    
-    payload = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials'
-    }
-    
+def get_access_token(token_cache):
+    """Get access token from the shared Oblio token cache (fetched from Oblio API only when needed)"""
     try:
-        response = requests.post(url, data=payload)
-        response.raise_for_status()
-        
-        token_data = response.json()
-        return token_data.get('access_token')
+        return token_cache.get_token()
     
+    except OblioAuthError as e:
+        print(f"Error getting access token: {e}")
+        return None
     except requests.exceptions.RequestException as e:
         print(f"Error getting access token: {e}")
         return None
@@ -47,12 +53,11 @@ def get_access_token(client_id, client_secret):
         print(f"Error parsing token response: {e}")
         return None
 
-def send_invoice_to_spv(access_token, cif, series_name, invoice_number):
-    """Send a single invoice to SPV"""
-    url = "https://www.oblio.eu/api/docs/einvoice"
+def send_invoice_to_spv(cif, series_name, invoice_number):
+    """Send a single invoice to SPV (the bearer token is attached by the oblio client)"""
+    url = "/api/docs/einvoice"
     
     headers = {
-        'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/x-www-form-urlencoded'
     }
     
@@ -63,7 +68,7 @@ def send_invoice_to_spv(access_token, cif, series_name, invoice_number):
     }
     
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        response = oblio.request("POST", url, headers=headers, data=payload)
         response.raise_for_status()
         
         result = response.json()
@@ -76,31 +81,123 @@ def send_invoice_to_spv(access_token, cif, series_name, invoice_number):
         print(f"Error parsing response for invoice {invoice_number}: {e}")
         return None
 
-def main():
-    """Main function to process invoice range"""
-    if len(sys.argv) != 3:
-        print("Usage: python sendspv.py <start_number> <end_number>")
-        print("Example: python sendspv.py 100 105")
-        sys.exit(1)
+def is_sent(result):
+    """True when Oblio reports the invoice as sent to SPV"""
+    if not result or result.get('status') != 200:
+        return False
+    data = result.get('data', {})
+    text = data.get('text', '')
     
-    try:
-        start_number = int(sys.argv[1])
-        end_number = int(sys.argv[2])
-    except ValueError:
-        print("Error: Start and end numbers must be integers")
-        sys.exit(1)
+    # Check for success indicators
+    return (data.get('sent') == True or 
+            'trimisa cu succes' in text.lower() or 
+            'factura a fost trimisa in spv' in text.lower())
+
+def submit_invoices(cif, invoices, workers, spv_submissions):
+    """Send (series_name, invoice_number) pairs with up to `workers` in flight, journaling every one of them
+    
+    Results are handled (printed and recorded) in invoice order. Returns the
+    number sent and {(series_name, invoice_number): error message} of the ones that failed.
+    """
+    successful_sends = 0
+    failed = {}
+    pending_invoices = iter(invoices)
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(in_flight) < workers:
+                invoice = next(pending_invoices, None)
+                if invoice is None:
+                    break
+                spv_submissions.mark_pending(*invoice)
+                in_flight.append((invoice, executor.submit(send_invoice_to_spv, cif, *invoice)))
+            if not in_flight:
+                break
+            
+            (series_name, invoice_number), future = in_flight.popleft()
+            result = future.result()
+            message = get_result_message(result)
+            
+            if is_sent(result):
+                print(f"Processing invoice {series_name}-{invoice_number}... ✓ SUCCESS")
+                spv_submissions.record(series_name, invoice_number, "sent", message)
+                successful_sends += 1
+            else:
+                print(f"Processing invoice {series_name}-{invoice_number}... ✗ FAILED: {message}")
+                spv_submissions.record(series_name, invoice_number, "failed", message)
+                failed[(series_name, invoice_number)] = message
+    return successful_sends, failed
+
+def get_result_message(result):
+    """Oblio's message for a submission ("API error" when there is no usable response)"""
+    if not result or result.get('status') != 200:
+        return "API error"
+    return result.get('data', {}).get('text', '')
+
+def parse_args():
+    """Command line options for sending invoices to SPV"""
+    parser = argparse.ArgumentParser(description="Send the invoices of the local ledger that are not in SPV yet",
+                                     epilog="Examples: python sendspv.py; python sendspv.py 4100 4105 --series AAA; "
+                                            "python sendspv.py --from 2025-03-01")
+    parser.add_argument("start_number", nargs="?", type=int, help="first invoice number (default: no lower limit)")
+    parser.add_argument("end_number", nargs="?", type=int, help="last invoice number (default: start_number)")
+    parser.add_argument("--series", action="append",
+                        help="invoice series to send (repeat for several; default: all series in the ledger)")
+    parser.add_argument("--from", dest="start_date", type=parse_date, metavar="YYYY-MM-DD",
+                        help="only invoices issued on or after this date")
+    parser.add_argument("--to", dest="end_date", type=parse_date, metavar="YYYY-MM-DD",
+                        help="only invoices issued on or before this date")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="maximum number of submissions in flight (default: 4)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="maximum requests per second to Oblio (default: OBLIO_REQUESTS_PER_SECOND)")
+    parser.add_argument("--retry-passes", type=int, default=2,
+                        help="extra passes over the invoices that failed (default: 2)")
+    parser.add_argument("--retry-delay", type=float, default=30,
+                        help="seconds to wait before the first retry pass, growing with each pass (default: 30)")
+    parser.add_argument("--resend", action="store_true",
+                        help="also send invoices the journal already records as sent")
+    return parser.parse_args()
+
+def main():
+    """Send the selected ledger invoices that are not confirmed in SPV yet"""
+    args = parse_args()
     
-    if start_number > end_number:
+    start_number = args.start_number
+    end_number = args.end_number if args.end_number is not None else start_number
+    if start_number is not None and start_number > end_number:
         print("Error: Start number must be less than or equal to end number")
         sys.exit(1)
     
-    if start_number <= 4000:
-        print("Error: Invoice numbers must be over 4000")
-        sys.exit(1)
+    # Only the invoices that still need a submission: each one is a single API call
+    spv_submissions = SpvSubmissions()
+    selection = dict(first_number=start_number, last_number=end_number,
+                     start_date=args.start_date, end_date=args.end_date)
+    # Ledger rows recorded before series were stored hold invoices of every series (EXT too), so they are
+    # only sent as the one --series asked for when an explicit number range says which invoices those are
+    legacy_series = args.series[0] if args.series and len(args.series) == 1 and start_number is not None else None
+    selected = spv_submissions.select_invoices(args.series, include_sent=True, legacy_series=legacy_series,
+                                               **selection)
+    invoices = [(row["series_name"], row["invoice_number"]) for row in selected
+                if args.resend or row["spv_status"] != "sent"]
+    already_sent = len(selected) - len(invoices)
     
-    if end_number <= 4000:
-        print("Error: Invoice numbers must be over 4000")
-        sys.exit(1)
+    without_series = 0 if legacy_series else spv_submissions.count_without_series(**selection)
+    if without_series:
+        print(f"⚠️  Skipping {without_series} ledger invoices without a series (recorded before series were stored); "
+              f"send them with a single --series and their number range")
+    if already_sent:
+        print(f"Skipping {already_sent} invoices already sent (use --resend to send them again)")
+    if not selected:
+        print("No invoices in the ledger match the selection")
+        return
+    if not invoices:
+        print("No invoices to send: everything selected is already in SPV")
+        return
+    
+    series_counts = {}
+    for series_name, _ in invoices:
+        series_counts[series_name] = series_counts.get(series_name, 0) + 1
     
     # Load environment variables
     try:
@@ -110,53 +207,51 @@ def main():
         print(f"Environment error: {e}")
         sys.exit(1)
     
+    # The token is cached on disk and refreshed before it expires, also during long runs
+    global oblio
+    token_cache = OblioTokenCache(client_id, client_secret)
+    oblio = http_client.oblio_client(auth=OblioBearerAuth(token_cache))
+    if args.rate:
+        rate_limit.set_rate(oblio.url("/"), args.rate, api=oblio.api)
+
     # Get access token
     print("Getting access token...")
-    access_token = get_access_token(client_id, client_secret)
+    access_token = get_access_token(token_cache)
     if not access_token:
         print("Failed to get access token")
         sys.exit(1)
     
     print("Access token obtained successfully")
     
-    # Default series name (you may need to adjust this based on your invoices)
-    series_name = "AAA"  # Change this to match your invoice series
-    
-    # Process invoices in the range
-    successful_sends = 0
-    failed_sends = 0
-    
-    print(f"\nSending invoices {start_number} to {end_number} to SPV...")
+    workers = max(1, args.workers)
+    print(f"\nSending {len(invoices)} invoices to SPV ({workers} in flight): "
+          f"{', '.join(f'{series_name} {count}' for series_name, count in series_counts.items())}")
     print("-" * 50)
     
-    for invoice_number in range(start_number, end_number + 1):
-        print(f"Processing invoice {series_name}-{invoice_number}...", end=" ")
-        
-        result = send_invoice_to_spv(access_token, cif, series_name, invoice_number)
-        
-        if result and result.get('status') == 200:
-            data = result.get('data', {})
-            text = data.get('text', '')
-            
-            # Check for success indicators
-            if (data.get('sent') == True or 
-                'trimisa cu succes' in text.lower() or 
-                'factura a fost trimisa in spv' in text.lower()):
-                print("✓ SUCCESS")
-                successful_sends += 1
-            else:
-                print(f"✗ FAILED: {text}")
-                print(f"Exiting after failure on invoice {invoice_number}")
-                sys.exit(1)
-        else:
-            print("✗ FAILED: API error")
-            print(f"Exiting after failure on invoice {invoice_number}")
-            sys.exit(1)
+    successful_sends, failed = submit_invoices(cif, invoices, workers, spv_submissions)
+    
+    # Failures are collected and retried in later passes instead of stopping the run
+    for retry_pass in range(1, args.retry_passes + 1):
+        if not failed:
+            break
+        delay = args.retry_delay * retry_pass
+        print(f"\nRetrying {len(failed)} failed invoices in {delay:.0f}s (pass {retry_pass}/{args.retry_passes})...")
+        time.sleep(delay)
+        retried_sends, failed = submit_invoices(cif, list(failed), workers, spv_submissions)
+        successful_sends += retried_sends
     
     # Summary
     print("-" * 50)
     print(f"Summary:")
     print(f"  Successful sends: {successful_sends}")
+    print(f"  Already sent before: {already_sent}")
+    print(f"  Failed: {len(failed)}")
+    for (series_name, invoice_number), message in failed.items():
+        print(f"    {series_name}-{invoice_number}: {message}")
+    
+    if failed:
+        print("Run sendspv.py again to retry the failed invoices")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
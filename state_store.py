@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+"""
+Local SQLite state for the integration
+
+One WAL-mode database (integration_state.db) replaces the JSON files that
+were fully loaded and rewritten on every change:
+
+  invoices          <- invoice_links.json           (main.py)
+  cancelled_orders  <- cancelled_orders_info.json   (main.py)
+  downloads         <- downloaded_invoices_log.json (download_invoices.py)
+  download_validators (ETag/Last-Modified for conditional and resumed downloads)
+  download_gaps     (ledger invoices download_invoices.py still has to download)
+  spv_submissions   (sendspv.py)
+  pdf_bundles, pdf_bundle_files (combine_pdfs.py: which PDFs each bundle holds)
+
+Each legacy JSON file is imported once, the first time its table is
+opened next to it; the file itself is left untouched.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+STATE_DB_FILE = "integration_state.db"
+LEGACY_INVOICE_LINKS_FILE = "invoice_links.json"
+LEGACY_CANCELLED_ORDERS_FILE = "cancelled_orders_info.json"
+LEGACY_DOWNLOADED_LOG_FILE = "downloaded_invoices_log.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    series_name TEXT,
+    invoice_number TEXT NOT NULL,
+    invoice_link TEXT,
+    total_amount REAL,
+    currency TEXT,
+    country_code TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_order_id ON invoices (order_id);
+CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices (invoice_number, series_name);
+CREATE INDEX IF NOT EXISTS idx_invoices_timestamp ON invoices (timestamp);
+
+CREATE TABLE IF NOT EXISTS cancelled_orders (
+    order_id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    order_number TEXT,
+    cancellation_reason TEXT,
+    total_price REAL,
+    gross_amount REAL,
+    customer_name TEXT,
+    order_date TEXT,
+    lines TEXT
+);
+
+CREATE TABLE IF NOT EXISTS downloads (
+    invoice_number TEXT NOT NULL,
+    series_name TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL,
+    order_id TEXT,
+    invoice_link TEXT,
+    filename TEXT,
+    status TEXT,
+    sha256 TEXT,
+    size INTEGER,
+    archive_path TEXT,
+    PRIMARY KEY (invoice_number, series_name)
+);
+
+CREATE TABLE IF NOT EXISTS download_validators (
+    invoice_number TEXT NOT NULL,
+    series_name TEXT NOT NULL DEFAULT '',
+    invoice_link TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    content_length INTEGER,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (invoice_number, series_name)
+);
+
+CREATE TABLE IF NOT EXISTS download_gaps (
+    series_name TEXT NOT NULL,
+    invoice_number TEXT NOT NULL,
+    PRIMARY KEY (series_name, invoice_number)
+);
+
+CREATE TABLE IF NOT EXISTS spv_submissions (
+    series_name TEXT NOT NULL,
+    invoice_number TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (series_name, invoice_number)
+);
+
+CREATE TABLE IF NOT EXISTS pdf_bundles (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    pages INTEGER,
+    size INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS pdf_bundle_files (
+    folder TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    bundle_path TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    PRIMARY KEY (folder, filename)
+);
+"""
+
+INVOICE_COLUMNS = ("timestamp", "order_id", "series_name", "invoice_number", "invoice_link",
+                   "total_amount", "currency", "country_code")
+CANCELLED_ORDER_COLUMNS = ("order_id", "timestamp", "order_number", "cancellation_reason", "total_price",
+                           "gross_amount", "customer_name", "order_date", "lines")
+DOWNLOAD_COLUMNS = ("invoice_number", "series_name", "timestamp", "order_id", "invoice_link", "filename", "status",
+                    "sha256", "size", "archive_path")
+
+# download_invoices.py commits its log every this many writes, or this many seconds after the first uncommitted one
+DOWNLOAD_LOG_BATCH_SIZE = 50
+DOWNLOAD_LOG_BATCH_SECONDS = 10
+
+# meta key of the last ledger row (invoices.id) download_invoices.py has looked at
+DOWNLOAD_WATERMARK_KEY = "download_watermark"
+
+# Columns added after a table was first created: {table: {column: definition}}
+ADDED_COLUMNS = {
+    "downloads": {"sha256": "TEXT", "size": "INTEGER", "archive_path": "TEXT"},
+}
+
+
+def connect(db_file=STATE_DB_FILE):
+    """Open the state database, creating the schema if needed"""
+    conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # WAL lets the scripts read while another one is writing
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Every commit is flushed to disk before we move on
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.executescript(SCHEMA)
+    add_missing_columns(conn)
+    return conn
+
+
+def add_missing_columns(conn):
+    """Bring tables created by an older version of the schema up to date"""
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, definition in columns.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    conn.commit()
+
+
+def insert_sql(table, columns, verb="INSERT"):
+    """Build an INSERT statement for the given columns"""
+    return f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+def selection_conditions(table, series_names=None, first_number=None, last_number=None, start_date=None,
+                         end_date=None):
+    """WHERE conditions and their params selecting invoices by series, number range and issue day
+
+    Series and numbers are matched on `table` (which has series_name and
+    invoice_number columns), days on the timestamp of the joined invoices
+    ledger. Dates are inclusive YYYY-MM-DD days.
+    """
+    conditions = []
+    params = []
+    if series_names:
+        conditions.append(f"{table}.series_name IN ({', '.join('?' * len(series_names))})")
+        params.extend(series_names)
+    if first_number is not None:
+        conditions.append(f"CAST({table}.invoice_number AS INTEGER) >= ?")
+        params.append(first_number)
+    if last_number is not None:
+        conditions.append(f"CAST({table}.invoice_number AS INTEGER) <= ?")
+        params.append(last_number)
+    if start_date:
+        conditions.append("invoices.timestamp >= ?")
+        params.append(start_date)
+    if end_date:
+        conditions.append("invoices.timestamp < date(?, '+1 day')")
+        params.append(end_date)
+    return conditions, params
+
+
+class SqliteStore:
+    """Base class for one table of the state database, safe to share between threads"""
+
+    def __init__(self, db_file=STATE_DB_FILE):
+        self.conn = connect(db_file)
+        self.lock = threading.Lock()
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def _import_legacy_json(self, legacy_file, import_records):
+        """Run import_records(records) once for the given legacy JSON file"""
+        meta_key = f"migrated:{os.path.basename(legacy_file)}"
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = ?", (meta_key,)).fetchone():
+                return
+            try:
+                with open(legacy_file, "r", encoding="utf-8") as f:
+                    records = json.load(f)
+            except FileNotFoundError:
+                records = []
+
+            with self.conn:
+                import_records(records)
+                self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                  (meta_key, datetime.now().isoformat()))
+
+        if records:
+            print(f"📦 Imported {len(records)} records from {legacy_file} into {STATE_DB_FILE}")
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        self.conn.close()
+
+
+class InvoiceLedger(SqliteStore):
+    """Append-only record of every invoice issued in Oblio"""
+
+    def __init__(self, db_file=STATE_DB_FILE, legacy_file=LEGACY_INVOICE_LINKS_FILE):
+        super().__init__(db_file)
+        self._import_legacy_json(legacy_file, lambda invoice_links: self.conn.executemany(
+            insert_sql("invoices", INVOICE_COLUMNS),
+            [tuple(invoice.get(column) for column in INVOICE_COLUMNS) for invoice in invoice_links]
+        ))
+
+    def add(self, order_id, invoice_link, invoice_number, total_amount,
+            series_name=None, currency=None, country_code=None):
+        """Append one invoice and commit it"""
+        invoice_data = {
+            "timestamp": datetime.now().isoformat(),
+            "order_id": order_id,
+            "series_name": series_name,
+            "invoice_number": invoice_number,
+            "invoice_link": invoice_link,
+            "total_amount": total_amount,
+            "currency": currency,
+            "country_code": country_code
+        }
+        with self.lock, self.conn:
+            self.conn.execute(insert_sql("invoices", INVOICE_COLUMNS),
+                              tuple(invoice_data[column] for column in INVOICE_COLUMNS))
+        return invoice_data
+
+    def find_by_order(self, order_id):
+        """All invoices issued for a shipment package id, oldest first"""
+        return self._query("SELECT * FROM invoices WHERE order_id = ? ORDER BY id", (str(order_id),))
+
+    def find_by_number(self, invoice_number, series_name=None):
+        """Invoices with the given number (optionally restricted to one series), oldest first"""
+        if series_name is None:
+            return self._query("SELECT * FROM invoices WHERE invoice_number = ? ORDER BY id", (str(invoice_number),))
+        return self._query("SELECT * FROM invoices WHERE invoice_number = ? AND series_name = ? ORDER BY id",
+                           (str(invoice_number), series_name))
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+    def all(self):
+        """Every invoice in the order it was recorded"""
+        return self._query("SELECT * FROM invoices ORDER BY id")
+
+
+class CancelledOrders(SqliteStore):
+    """Cancelled orders seen while processing, one row per order id
+
+    Known order ids are loaded once into a set, so duplicate checks are O(1).
+    New cancellations are queued in memory and written in a single
+    transaction by flush(), typically once at the end of a run.
+    """
+
+    def __init__(self, db_file=STATE_DB_FILE, legacy_file=LEGACY_CANCELLED_ORDERS_FILE):
+        super().__init__(db_file)
+        self._import_legacy_json(legacy_file, lambda cancelled_orders: self.conn.executemany(
+            insert_sql("cancelled_orders", CANCELLED_ORDER_COLUMNS, "INSERT OR IGNORE"),
+            [self._to_row(cancelled_order) for cancelled_order in cancelled_orders]
+        ))
+        self.known_order_ids = {row[0] for row in self.conn.execute("SELECT order_id FROM cancelled_orders")}
+        self.pending = []
+
+    @staticmethod
+    def _to_row(cancelled_order):
+        row = dict(cancelled_order, order_id=str(cancelled_order.get("order_id")),
+                   lines=json.dumps(cancelled_order.get("lines", []), ensure_ascii=False))
+        return tuple(row.get(column) for column in CANCELLED_ORDER_COLUMNS)
+
+    def exists(self, order_id):
+        with self.lock:
+            return str(order_id) in self.known_order_ids
+
+    def add(self, cancelled_order):
+        """Queue a cancelled order for the next flush(); returns False if it was already known"""
+        order_id = str(cancelled_order.get("order_id"))
+        with self.lock:
+            if order_id in self.known_order_ids:
+                return False
+            self.known_order_ids.add(order_id)
+            self.pending.append(self._to_row(cancelled_order))
+        return True
+
+    def flush(self):
+        """Write all queued cancellations in one transaction; returns how many were written"""
+        with self.lock:
+            if not self.pending:
+                return 0
+            with self.conn:
+                self.conn.executemany(insert_sql("cancelled_orders", CANCELLED_ORDER_COLUMNS, "INSERT OR IGNORE"),
+                                      self.pending)
+            written = len(self.pending)
+            self.pending = []
+        return written
+
+    def close(self):
+        self.flush()
+        super().close()
+
+    def all(self):
+        cancelled_orders = self._query("SELECT * FROM cancelled_orders ORDER BY timestamp")
+        for cancelled_order in cancelled_orders:
+            cancelled_order["lines"] = json.loads(cancelled_order["lines"] or "[]")
+        return cancelled_orders
+
+
+class DownloadLog(SqliteStore):
+    """Invoice PDFs already downloaded by download_invoices.py
+
+    The downloaded invoice numbers are loaded once from the primary key index
+    into a per-series set. What still needs downloading is kept as a gap set
+    fed from the ledger rows past a watermark, so a run only reads the new
+    ledger rows.
+    Writes are batched: rows join an open transaction that is committed every
+    batch_size writes, by a timer batch_seconds after the batch was opened,
+    and on flush()/close(). A crash loses at most one batch. Those files are
+    then found on disk and revalidated on the next run. Validators are
+    committed as soon as they are saved (with the batch open at that moment),
+    since a resumed download depends on them.
+    """
+
+    def __init__(self, db_file=STATE_DB_FILE, legacy_file=LEGACY_DOWNLOADED_LOG_FILE,
+                 batch_size=DOWNLOAD_LOG_BATCH_SIZE, batch_seconds=DOWNLOAD_LOG_BATCH_SECONDS):
+        super().__init__(db_file)
+        self._import_legacy_json(legacy_file, lambda downloaded_log: self.conn.executemany(
+            insert_sql("downloads", DOWNLOAD_COLUMNS, "INSERT OR IGNORE"),
+            [self._to_row(entry) for entry in downloaded_log]
+        ))
+        self._fill_missing_series()
+        self.downloaded = {}
+        for series_name, invoice_number in self.conn.execute("SELECT series_name, invoice_number FROM downloads"):
+            self.downloaded.setdefault(series_name, set()).add(invoice_number)
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.pending_writes = 0
+        self.commit_timer = None
+
+    def _fill_missing_series(self):
+        """Give rows imported without a series the series of the ledger invoice with that number (once)
+
+        Only numbers issued in exactly one series are updated; the rest keep ''
+        and stay keyed by number alone.
+        """
+        meta_key = "migrated:download_series"
+        with self.lock, self.conn:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = ?", (meta_key,)).fetchone():
+                return
+            self.conn.execute("""
+                UPDATE OR IGNORE downloads SET series_name = (
+                    SELECT MAX(series_name) FROM invoices WHERE invoices.invoice_number = downloads.invoice_number
+                )
+                WHERE series_name = ''
+                  AND (SELECT COUNT(DISTINCT COALESCE(series_name, '')) FROM invoices
+                       WHERE invoices.invoice_number = downloads.invoice_number) = 1
+            """)
+            self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (meta_key, datetime.now().isoformat()))
+
+    @staticmethod
+    def _to_row(entry):
+        row = dict(entry, invoice_number=str(entry.get("invoice_number")),
+                   series_name=entry.get("series_name") or "")
+        return tuple(row.get(column) for column in DOWNLOAD_COLUMNS)
+
+    def _write(self, sql, params):
+        """Execute one write inside the current batch, committing when the batch is full"""
+        self.conn.execute(sql, params)
+        self.pending_writes += 1
+        if self.pending_writes >= self.batch_size:
+            self._commit()
+        elif self.commit_timer is None:
+            # The write transaction never stays open longer than batch_seconds, even if no more writes come
+            self.commit_timer = threading.Timer(self.batch_seconds, self.flush)
+            self.commit_timer.daemon = True
+            self.commit_timer.start()
+
+    def _commit(self):
+        self.conn.commit()
+        self.pending_writes = 0
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+
+    def flush(self):
+        """Commit any batched writes"""
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+    def is_downloaded(self, invoice_number, series_name=""):
+        with self.lock:
+            return str(invoice_number) in self.downloaded.get(series_name or "", ())
+
+    def add(self, entry):
+        """Record a downloaded invoice (committed with the current batch)"""
+        with self.lock:
+            self._write(insert_sql("downloads", DOWNLOAD_COLUMNS, "INSERT OR REPLACE"), self._to_row(entry))
+            self._write("DELETE FROM download_gaps WHERE series_name = ? AND invoice_number = ?",
+                        (entry.get("series_name") or "", str(entry.get("invoice_number"))))
+            self.downloaded.setdefault(entry.get("series_name") or "", set()).add(str(entry.get("invoice_number")))
+
+    def get_validators(self, invoice_number, series_name=""):
+        """ETag/Last-Modified/Content-Length seen for this invoice's link ({} if unknown)"""
+        rows = self._query("SELECT etag, last_modified, content_length FROM download_validators "
+                           "WHERE invoice_number = ? AND series_name = ?", (str(invoice_number), series_name or ""))
+        return rows[0] if rows else {}
+
+    def save_validators(self, invoice_number, series_name, invoice_link, validators):
+        """Remember the validators of a response as soon as its headers arrive (committed right away)"""
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO download_validators
+                    (invoice_number, series_name, invoice_link, etag, last_modified, content_length, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (str(invoice_number), series_name or "", invoice_link, validators.get("etag"),
+                  validators.get("last_modified"), validators.get("content_length"), datetime.now().isoformat()))
+            self._commit()
+
+    def downloaded_invoice_numbers(self):
+        """{series_name: set of downloaded invoice numbers}"""
+        with self.lock:
+            return {series_name: set(numbers) for series_name, numbers in self.downloaded.items()}
+
+    def get_series(self, invoice_number):
+        """Series recorded for a downloaded invoice number ('' if unknown)"""
+        with self.lock:
+            row = self.conn.execute("SELECT series_name FROM downloads WHERE invoice_number = ?",
+                                    (str(invoice_number),)).fetchone()
+        return row[0] if row else ""
+
+    def set_archive_path(self, invoice_number, series_name, archive_path):
+        """Point an existing log row at its file in the invoice archive"""
+        with self.lock:
+            self._write("UPDATE downloads SET archive_path = ? WHERE invoice_number = ? AND series_name = ?",
+                        (archive_path, str(invoice_number), series_name or ""))
+
+    def _update_gaps(self):
+        """Move the ledger rows appended since the last run into the gap set (unless already downloaded)
+
+        The watermark is the ledger row id rather than an invoice number, so a
+        lower number recorded late is still picked up.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (DOWNLOAD_WATERMARK_KEY,)).fetchone()
+        new_rows = self.conn.execute("""
+            SELECT id, COALESCE(series_name, ''), invoice_number FROM invoices WHERE id > ? ORDER BY id
+        """, (int(row[0]) if row else 0,)).fetchall()
+        if not new_rows:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO download_gaps (series_name, invoice_number) VALUES (?, ?)",
+                                  [(series_name, invoice_number) for _, series_name, invoice_number in new_rows
+                                   if invoice_number not in self.downloaded.get(series_name, ())])
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                              (DOWNLOAD_WATERMARK_KEY, str(new_rows[-1][0])))
+
+    def pending_invoices(self):
+        """Latest ledger row of every (series, number) not downloaded yet, by series and number
+
+        Only the gap set is joined with the ledger: invoices that failed stay
+        in it until add() records them, whatever their number and however late
+        they were issued.
+        """
+        with self.lock:
+            self._update_gaps()
+        pending = self._query("""
+            SELECT invoices.*, MAX(invoices.timestamp) AS latest_timestamp
+            FROM download_gaps
+            JOIN invoices ON invoices.invoice_number = download_gaps.invoice_number
+                         AND COALESCE(invoices.series_name, '') = download_gaps.series_name
+            GROUP BY download_gaps.series_name, download_gaps.invoice_number
+            ORDER BY download_gaps.series_name, CAST(download_gaps.invoice_number AS INTEGER),
+                     download_gaps.invoice_number
+        """)
+        for invoice in pending:
+            del invoice["latest_timestamp"]
+        return pending
+
+    def select_invoices(self, series_names=None, first_number=None, last_number=None, start_date=None, end_date=None,
+                        country_code=None):
+        """Downloaded invoices in the archive matching every given filter, by series and numeric invoice number
+
+        Dates are inclusive YYYY-MM-DD days of the invoice timestamp in the
+        ledger; the latest ledger row of each invoice provides date and country.
+        """
+        conditions, params = selection_conditions("downloads", series_names, first_number, last_number,
+                                                  start_date, end_date)
+        conditions.append("downloads.archive_path IS NOT NULL")
+        if country_code:
+            conditions.append("invoices.country_code = ?")
+            params.append(country_code)
+        return self._query(f"""
+            SELECT downloads.series_name, downloads.invoice_number, downloads.archive_path,
+                   invoices.country_code, MAX(invoices.timestamp) AS invoice_timestamp
+            FROM downloads
+            LEFT JOIN invoices ON invoices.invoice_number = downloads.invoice_number
+                              AND COALESCE(invoices.series_name, '') = downloads.series_name
+            WHERE {' AND '.join(conditions)}
+            GROUP BY downloads.series_name, downloads.invoice_number
+            ORDER BY downloads.series_name, CAST(downloads.invoice_number AS INTEGER), downloads.invoice_number
+        """, params)
+
+    def all(self):
+        return self._query("SELECT * FROM downloads ORDER BY timestamp")
+
+
+class SpvSubmissions(SqliteStore):
+    """Journal of SPV (e-Factura) submissions: 'pending', then 'sent' or 'failed' for each invoice
+
+    An invoice is marked pending just before it is sent, so one left pending
+    was interrupted mid-submission and is sent again by the next run.
+    """
+
+    def get(self, series_name, invoice_number):
+        rows = self._query("SELECT * FROM spv_submissions WHERE series_name = ? AND invoice_number = ?",
+                           (series_name, str(invoice_number)))
+        return rows[0] if rows else None
+
+    def select_invoices(self, series_names=None, first_number=None, last_number=None,
+                        start_date=None, end_date=None, include_sent=False, legacy_series=None):
+        """Invoices from the ledger that are not confirmed as sent to SPV, by series and number
+
+        Dates are inclusive (YYYY-MM-DD) and match the time the invoice was
+        issued. Ledger rows without a series (imported from old JSON files)
+        are taken as legacy_series when it is given (only safe together with
+        a number range known to be in that series) and left out otherwise;
+        count them with count_without_series().
+        """
+        conditions, params = selection_conditions("invoices", series_names, first_number, last_number,
+                                                  start_date, end_date)
+        params.insert(0, legacy_series)
+        conditions.append("invoices.series_name IS NOT NULL")
+        if not include_sent:
+            conditions.append("""NOT EXISTS (SELECT 1 FROM spv_submissions
+                                             WHERE spv_submissions.series_name = invoices.series_name
+                                               AND spv_submissions.invoice_number = invoices.invoice_number
+                                               AND spv_submissions.status = 'sent')""")
+        return self._query(f"""
+            SELECT invoices.series_name, invoices.invoice_number, MAX(invoices.timestamp) AS invoice_timestamp,
+                   spv_submissions.status AS spv_status
+            FROM (SELECT COALESCE(series_name, ?) AS series_name, invoice_number, timestamp FROM invoices) AS invoices
+            LEFT JOIN spv_submissions ON spv_submissions.series_name = invoices.series_name
+                                     AND spv_submissions.invoice_number = invoices.invoice_number
+            WHERE {' AND '.join(conditions)}
+            GROUP BY invoices.series_name, invoices.invoice_number
+            ORDER BY invoices.series_name, CAST(invoices.invoice_number AS INTEGER), invoices.invoice_number
+        """, params)
+
+    def count_without_series(self, first_number=None, last_number=None, start_date=None, end_date=None):
+        """Number of ledger invoices in the selection whose series was never recorded"""
+        conditions, params = selection_conditions("invoices", None, first_number, last_number, start_date, end_date)
+        conditions.append("invoices.series_name IS NULL")
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(DISTINCT invoice_number) FROM invoices "
+                                     f"WHERE {' AND '.join(conditions)}", params).fetchone()[0]
+
+    def mark_pending(self, series_name, invoice_number):
+        """Journal that a submission is about to be made (attempts are counted by record())"""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO spv_submissions (series_name, invoice_number, status, message, attempts, timestamp)
+                VALUES (?, ?, 'pending', '', 0, ?)
+                ON CONFLICT (series_name, invoice_number) DO UPDATE SET
+                    status = excluded.status,
+                    timestamp = excluded.timestamp
+            """, (series_name, str(invoice_number), datetime.now().isoformat()))
+
+    def record(self, series_name, invoice_number, status, message=""):
+        """Store the outcome of a submission attempt ('sent' or 'failed')"""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO spv_submissions (series_name, invoice_number, status, message, attempts, timestamp)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT (series_name, invoice_number) DO UPDATE SET
+                    status = excluded.status,
+                    message = excluded.message,
+                    attempts = attempts + 1,
+                    timestamp = excluded.timestamp
+            """, (series_name, str(invoice_number), status, message, datetime.now().isoformat()))
+
+
+class PdfBundles(SqliteStore):
+    """Combined PDF bundles and the invoice PDFs that went into each of them
+
+    Files are identified by folder and name; their size and mtime tell
+    whether a file changed after it was bundled.
+    """
+
+    def bundled_files(self, folder):
+        """{filename: (bundle_path, size, mtime_ns)} of the files already in a bundle that still exists"""
+        with self.lock, self.conn:
+            for (bundle_path,) in self.conn.execute("SELECT path FROM pdf_bundles WHERE folder = ?",
+                                                    (folder,)).fetchall():
+                if not os.path.exists(bundle_path):
+                    self._forget_bundle(bundle_path)
+            rows = self.conn.execute("SELECT filename, bundle_path, size, mtime_ns FROM pdf_bundle_files "
+                                     "WHERE folder = ?", (folder,)).fetchall()
+        return {filename: (bundle_path, size, mtime_ns) for filename, bundle_path, size, mtime_ns in rows}
+
+    def _forget_bundle(self, bundle_path):
+        self.conn.execute("DELETE FROM pdf_bundle_files WHERE bundle_path = ?", (bundle_path,))
+        self.conn.execute("DELETE FROM pdf_bundles WHERE path = ?", (bundle_path,))
+
+    def forget_bundle(self, bundle_path):
+        """Drop a bundle so its files are bundled again"""
+        with self.lock, self.conn:
+            self._forget_bundle(bundle_path)
+
+    def add(self, folder, bundle_path, pages, files):
+        """Record a bundle and its files as (filename, size, mtime_ns)"""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO pdf_bundles (path, folder, timestamp, pages, size) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (bundle_path, folder, datetime.now().isoformat(), pages, os.path.getsize(bundle_path)))
+            self.conn.executemany("INSERT OR REPLACE INTO pdf_bundle_files "
+                                  "(folder, filename, bundle_path, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                                  [(folder, filename, bundle_path, size, mtime_ns)
+                                   for filename, size, mtime_ns in files])
+
+    def bundles(self, folder):
+        """Paths of the bundles of a folder that still hold at least one file, by name"""
+        return [row["bundle_path"] for row in self._query(
+            "SELECT DISTINCT bundle_path FROM pdf_bundle_files WHERE folder = ? ORDER BY bundle_path", (folder,))]
+
+    def forget_folder(self, folder):
+        """Drop the bundle history of a folder so everything is bundled again; returns the forgotten bundle paths"""
+        with self.lock, self.conn:
+            bundle_paths = [bundle_path for (bundle_path,) in self.conn.execute(
+                "SELECT path FROM pdf_bundles WHERE folder = ? ORDER BY path", (folder,)).fetchall()]
+            self.conn.execute("DELETE FROM pdf_bundle_files WHERE folder = ?", (folder,))
+            self.conn.execute("DELETE FROM pdf_bundles WHERE folder = ?", (folder,))
+        return bundle_paths
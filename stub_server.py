@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Oblio and Trendyol APIs, for offline and reproducible runs
+
+Serves the endpoints used by main.py, sendspv.py and download_invoices.py:
+
+  POST /api/authorize/token                                   Oblio access token
+  POST /api/docs/invoice                                      issue an invoice (numbered per series)
+  POST /api/docs/einvoice                                     send an invoice to SPV
+  GET  /integration/order/sellers/<id>/orders                 shipment packages, paginated
+  POST /integration/sellers/<id>/seller-invoice-links         attach an invoice link to a package
+  GET  /pdf/<series>/<number>                                 invoice PDF (ETag, Range, If-None-Match)
+  GET  /stub/stats                                            request counters of this stub
+
+Orders are generated from --seed, so every run starts from the same data.
+Latency, injected errors and rate limiting (429 with Retry-After) are set
+on the command line. Point the scripts at it with:
+
+  OBLIO_API_URL=http://127.0.0.1:8080 TRENDYOL_API_URL=http://127.0.0.1:8080 python main.py
+
+(any values work for SELLER_ID, API_KEY, API_SECRET, CIF, CLIENT_ID and CLIENT_SECRET)
+
+Usage: python stub_server.py [--port 8080] [--orders 300] [--latency 0.2] [--error-rate 0.05] [--rate 10]
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from rate_limit import TokenBucket
+
+ACCESS_TOKEN = "stub-access-token"
+# Trendyol caps the page size of the shipment packages listing at 200
+MAX_PAGE_SIZE = 200
+BUCHAREST_COUNTY_ID = 12261437
+
+ORDERS_PATH = re.compile(r"^/integration/order/sellers/[^/]+/orders$")
+INVOICE_LINKS_PATH = re.compile(r"^/integration/sellers/[^/]+/seller-invoice-links$")
+PDF_PATH = re.compile(r"^/pdf/([^/]+)/(\d+)$")
+
+# (country code, country, city, county id, postal code) of the generated invoice addresses
+ADDRESSES = [
+    ("RO", "Romania", "Cluj-Napoca", 12261412, "400001"),
+    ("RO", "Romania", "Bucuresti", BUCHAREST_COUNTY_ID, "031234"),
+    ("RO", "Romania", "Bucuresti", BUCHAREST_COUNTY_ID, "060011"),
+    ("RO", "Romania", "Iasi", 12261422, "700001"),
+    ("GR", "Greece", "Athens", 0, "10431"),
+    ("BG", "Bulgaria", "Sofia", 0, "1000"),
+]
+
+
+class StubState:
+    """In-memory orders, issued invoices and SPV submissions, shared by all request threads"""
+
+    def __init__(self, order_count, seed, first_number):
+        self.lock = threading.Lock()
+        self.orders = generate_orders(order_count, seed)
+        self.orders_by_package = {order["shipmentPackageId"]: order for order in self.orders}
+        self.invoices = {}
+        self.next_numbers = {}
+        self.first_number = first_number
+        self.sent_to_spv = set()
+        self.stats = {}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def issue_invoice(self, series_name, total):
+        with self.lock:
+            number = self.next_numbers.get(series_name, self.first_number)
+            self.next_numbers[series_name] = number + 1
+            self.invoices[(series_name, number)] = {"total": total, "timestamp": time.time()}
+            return number
+
+
+def generate_orders(order_count, seed):
+    """Deterministic shipment packages shaped like the Trendyol order listing"""
+    rng = random.Random(seed)
+    start_ms = int(datetime(2025, 1, 1).timestamp() * 1000)
+    orders = []
+    for index in range(order_count):
+        country_code, country, city, county_id, postal_code = rng.choice(ADDRESSES)
+        status = rng.choices(["Created", "Picking", "Cancelled", "Awaiting"], weights=[60, 30, 5, 5])[0]
+        lines = []
+        for line_index in range(rng.randint(1, 3)):
+            price = round(rng.uniform(20, 300), 2)
+            discount = rng.choice([0, 0, 0, round(price * 0.1, 2)])
+            lines.append({
+                "productName": f"Product {rng.randint(1, 500)}",
+                "contentId": rng.randint(100000, 999999),
+                "quantity": rng.randint(1, 3),
+                "price": price,
+                "amount": price,
+                "lineGrossAmount": price,
+                "lineTotalDiscount": discount,
+                "discountDetails": [{"lineItemPrice": price - discount, "lineItemDiscount": discount,
+                                     "lineItemTyDiscount": 0}],
+                "orderLineItemStatusName": status,
+            })
+        total = round(sum((line["lineGrossAmount"] - line["lineTotalDiscount"]) * line["quantity"]
+                          for line in lines), 2)
+        last_modified = start_ms + index * 60_000
+        orders.append({
+            "id": 900000000 + index,
+            "shipmentPackageId": 3000000000 + index,
+            "orderNumber": f"10{index:08d}",
+            "customerId": 5000000 + rng.randint(0, 99999),
+            "customerFirstName": f"First{index}",
+            "customerLastName": f"Last{index}",
+            "currencyCode": "RON" if country_code == "RO" else "EUR",
+            "totalPrice": total,
+            "grossAmount": total,
+            "packageTotalPrice": total,
+            "orderDate": last_modified,
+            "lastModifiedDate": last_modified,
+            "status": status,
+            "packageHistories": [{"createdDate": last_modified, "status": status}],
+            "invoiceAddress": {
+                "firstName": f"First{index}",
+                "lastName": f"Last{index}",
+                "address1": f"Street {rng.randint(1, 200)}",
+                "address2": rng.choice(["", f"Ap. {rng.randint(1, 90)}"]),
+                "city": city,
+                "countyId": county_id,
+                "countyName": city,
+                "stateName": city if country_code != "RO" else None,
+                "postalCode": postal_code,
+                "countryCode": country_code,
+                "fullAddress": country,
+            },
+            "lines": lines,
+        })
+    return orders
+
+
+def make_pdf(series_name, number):
+    """A small valid single-page PDF for an invoice"""
+    text = f"Factura {series_name} {number}".encode()
+    stream = b"BT /F1 24 Tf 72 720 Td (" + text + b") Tj ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for index, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{index} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+    return pdf
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Routes requests to the Oblio/Trendyol handlers after applying latency, errors and rate limits"""
+
+    protocol_version = "HTTP/1.1"
+    state = None
+    options = None
+    limiters = {}
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def get_api(self, path):
+        if path.startswith("/api/"):
+            return "oblio"
+        if path.startswith("/integration/"):
+            return "trendyol"
+        return "pdf"
+
+    def simulate_conditions(self, api):
+        """Apply latency, rate limiting and injected errors; returns True when a response was already sent"""
+        self.state.count(f"{api} requests")
+        if self.options.latency or self.options.jitter:
+            time.sleep(self.options.latency + random.uniform(0, self.options.jitter))
+
+        limiter = self.limiters.get(api)
+        wait_time = limiter.try_acquire() if limiter else 0
+        if wait_time:
+            self.state.count(f"{api} 429")
+            self.read_body()
+            self.send_json(429, {"status": 429, "statusMessage": "Too Many Requests"},
+                           {"Retry-After": str(max(1, math.ceil(wait_time)))})
+            return True
+
+        if self.options.error_rate and random.random() < self.options.error_rate:
+            self.state.count(f"{api} {self.options.error_status}")
+            self.read_body()
+            self.send_json(self.options.error_status, {"status": self.options.error_status,
+                                                       "statusMessage": "Injected error"})
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stub/stats":
+            with self.state.lock:
+                stats = dict(self.state.stats, invoices=len(self.state.invoices),
+                             sent_to_spv=len(self.state.sent_to_spv))
+            return self.send_json(200, stats)
+        if self.simulate_conditions(self.get_api(url.path)):
+            return
+        if ORDERS_PATH.match(url.path):
+            return self.get_orders(parse_qs(url.query))
+        match = PDF_PATH.match(url.path)
+        if match:
+            return self.get_pdf(match.group(1), int(match.group(2)))
+        self.send_json(404, {"status": 404, "statusMessage": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if self.simulate_conditions(self.get_api(path)):
+            return
+        body = self.read_body()
+        if path == "/api/authorize/token":
+            return self.send_json(200, {"access_token": ACCESS_TOKEN, "token_type": "Bearer",
+                                        "expires_in": str(self.options.token_ttl)})
+        if path.startswith("/api/") and self.headers.get("Authorization") != f"Bearer {ACCESS_TOKEN}":
+            return self.send_json(401, {"status": 401, "statusMessage": "Invalid access token"})
+        if path == "/api/docs/invoice":
+            return self.post_invoice(json.loads(body or b"{}"))
+        if path == "/api/docs/einvoice":
+            form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            return self.post_einvoice(form)
+        if INVOICE_LINKS_PATH.match(path):
+            return self.post_invoice_link(json.loads(body or b"{}"))
+        self.send_json(404, {"status": 404, "statusMessage": f"Unknown path {path}"})
+
+    def get_orders(self, query):
+        page = int(query.get("page", ["0"])[0])
+        size = min(int(query.get("size", ["50"])[0]), MAX_PAGE_SIZE)
+        start_date = int(query["startDate"][0]) if "startDate" in query else None
+        end_date = int(query["endDate"][0]) if "endDate" in query else None
+        with self.state.lock:
+            orders = [order for order in self.state.orders
+                      if (start_date is None or order["lastModifiedDate"] >= start_date)
+                      and (end_date is None or order["lastModifiedDate"] <= end_date)]
+            if query.get("orderByField", [""])[0] == "PackageLastModifiedDate":
+                orders.sort(key=lambda order: order["lastModifiedDate"],
+                            reverse=query.get("orderByDirection", ["ASC"])[0] == "DESC")
+            content = json.loads(json.dumps(orders[page * size:(page + 1) * size]))
+        self.send_json(200, {
+            "totalElements": len(orders),
+            "totalPages": math.ceil(len(orders) / size) if orders else 0,
+            "page": page,
+            "size": size,
+            "content": content,
+        })
+
+    def post_invoice_link(self, payload):
+        with self.state.lock:
+            order = self.state.orders_by_package.get(payload.get("shipmentPackageId"))
+            if order is not None:
+                order["invoiceLink"] = payload.get("invoiceLink")
+                order["lastModifiedDate"] = int(time.time() * 1000)
+        if order is None:
+            return self.send_json(400, {"errors": [{"message": "Shipment package not found"}]})
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def post_invoice(self, payload):
+        total = 0.0
+        for product in payload.get("products", []):
+            if product.get("name") == "Discount":
+                total -= product.get("discount", 0)
+            else:
+                total += product.get("price", 0) * product.get("quantity", 1)
+        series_name = payload.get("seriesName") or "AAA"
+        number = self.state.issue_invoice(series_name, round(total, 2))
+        host = self.headers.get("Host", f"127.0.0.1:{self.options.port}")
+        self.send_json(200, {"status": 200, "statusMessage": "Success", "data": {
+            "seriesName": series_name,
+            "number": str(number),
+            "link": f"http://{host}/pdf/{series_name}/{number}",
+            "total": f"{total:.2f}",
+        }})
+
+    def post_einvoice(self, form):
+        invoice = (form.get("seriesName"), int(form.get("number") or 0))
+        with self.state.lock:
+            known = invoice in self.state.invoices
+            if known:
+                self.state.sent_to_spv.add(invoice)
+        if not known:
+            return self.send_json(200, {"status": 404, "statusMessage": "Factura nu exista"})
+        self.send_json(200, {"status": 200, "statusMessage": "Success",
+                             "data": {"sent": True, "text": "Factura a fost trimisa in SPV"}})
+
+    def get_pdf(self, series_name, number):
+        with self.state.lock:
+            invoice = self.state.invoices.get((series_name, number))
+        if invoice is None and not self.options.any_pdf:
+            return self.send_json(404, {"status": 404, "statusMessage": "Factura nu exista"})
+        data = make_pdf(series_name, number)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        headers = {"ETag": etag, "Last-Modified": formatdate((invoice or {}).get("timestamp", 0), usegmt=True),
+                   "Content-Type": "application/pdf", "Accept-Ranges": "bytes"}
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        status = 200
+        body = data
+        range_header = self.headers.get("Range", "")
+        if_range = self.headers.get("If-Range")
+        match = re.match(r"bytes=(\d+)-$", range_header)
+        if match and (if_range is None or if_range == etag):
+            start = int(match.group(1))
+            if start >= len(data):
+                # Like a real server: a range starting at or past the end can't be satisfied
+                return self.send_json(416, {"status": 416, "statusMessage": "Range Not Satisfiable"},
+                                      {"Content-Range": f"bytes */{len(data)}"})
+            status = 206
+            body = data[start:]
+            headers["Content-Range"] = f"bytes {start}-{len(data) - 1}/{len(data)}"
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Oblio and Trendyol APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--orders", type=int, default=300, help="number of generated shipment packages (default: 300)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated orders (default: 1)")
+    parser.add_argument("--first-number", type=int, default=1001,
+                        help="first invoice number of every series (default: 1001)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with --error-status (default: 0)")
+    parser.add_argument("--error-status", type=int, default=503, help="status of injected errors (default: 503)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="requests per second allowed per API (oblio, trendyol, pdf) before answering 429")
+    parser.add_argument("--burst", type=int, default=None, help="requests allowed in a burst (default: --rate)")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="lifetime of issued access tokens in seconds")
+    parser.add_argument("--any-pdf", action="store_true", help="serve PDFs also for invoices this stub did not issue")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    random.seed(options.seed)
+    StubHandler.options = options
+    StubHandler.state = StubState(options.orders, options.seed, options.first_number)
+    if options.rate:
+        burst = options.burst or max(1, int(options.rate))
+        StubHandler.limiters = {api: TokenBucket(options.rate, burst) for api in ("oblio", "trendyol", "pdf")}
+
+    server = ThreadingHTTPServer((options.host, options.port), StubHandler)
+    server.daemon_threads = True
+    print(f"🧪 Stub Oblio/Trendyol API on http://{options.host}:{options.port} "
+          f"({options.orders} orders, latency {options.latency}s, error rate {options.error_rate}, "
+          f"rate limit {options.rate or 'off'})")
+    # Print the counters also when stopped with kill (SIGTERM)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"📊 {json.dumps(StubHandler.state.stats, sort_keys=True)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Test script for incremental PDF bundling
+Runs combine_pdfs_in_folder on generated invoice PDFs in a temporary folder (and state database)
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from PyPDF2 import PdfReader, PdfWriter
+from state_store import PdfBundles
+from combine_pdfs import combine_pdfs_in_folder
+
+
+def write_invoice_pdf(folder, invoice_number):
+    """A one page PDF whose page width is the invoice number, so the pages can be told apart"""
+    writer = PdfWriter()
+    writer.add_blank_page(width=invoice_number, height=100)
+    with open(Path(folder) / f"Trendyol_Factura_{invoice_number}.pdf", "wb") as f:
+        writer.write(f)
+
+
+def page_numbers(pdf_file):
+    """Invoice numbers of the pages of a bundle, in page order"""
+    return [int(float(page.mediabox.width)) for page in PdfReader(str(pdf_file)).pages]
+
+
+def test_concatenate_after_incremental_run():
+    """--concatenate after a delta bundle keeps the bundles intact and writes every invoice once, in order"""
+    folder = Path("invoices")
+    folder.mkdir()
+    for invoice_number in (9, 10, 11, 9999, 10000):
+        write_invoice_pdf(folder, invoice_number)
+    combine_pdfs_in_folder(folder, workers=2)
+
+    write_invoice_pdf(folder, 12)
+    for _ in range(2):
+        combine_pdfs_in_folder(folder, workers=2, concatenate=True)
+
+    bundles = {Path(bundle_path).name: page_numbers(bundle_path)
+               for bundle_path in PdfBundles().bundles(str(folder.resolve()))}
+    print(f"   Bundles: {bundles}")
+    assert bundles == {"Trendyol_Factura_9-Trendyol_Factura_10000.pdf": [9, 10, 11, 9999, 10000],
+                       "Trendyol_Factura_12-Trendyol_Factura_12.pdf": [12]}
+
+    concatenated = folder / "Trendyol_Factura_9-Trendyol_Factura_10000_all.pdf"
+    assert concatenated.exists()
+    print(f"   {concatenated.name}: {page_numbers(concatenated)}")
+    assert page_numbers(concatenated) == [9, 10, 11, 12, 9999, 10000]
+
+
+def main():
+    """Run all PDF bundling tests"""
+    print("🧪 PDF BUNDLING TESTS")
+    print("=" * 60)
+
+    tests = [
+        test_concatenate_after_incremental_run,
+    ]
+
+    # Bundles are recorded in integration_state.db of the working folder: run each test in a fresh one
+    working_folder = os.getcwd()
+    failed = 0
+    for test in tests:
+        print(f"\n🔍 {test.__doc__}")
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                test()
+                print("   ✅ PASS")
+            except AssertionError:
+                print("   ❌ FAIL")
+                failed += 1
+            finally:
+                os.chdir(working_folder)
+
+    print(f"\n{'='*60}")
+    print(f"Passed: {len(tests) - failed}/{len(tests)}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    main()
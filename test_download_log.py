@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Test script for the selection of invoices still to download
+Checks DownloadLog.pending_invoices (watermark + gap set) against a temporary state database
+"""
+
+import os
+import tempfile
+from datetime import datetime
+from state_store import InvoiceLedger, DownloadLog, DOWNLOAD_WATERMARK_KEY
+
+
+class Run:
+    """One download_invoices.py run: a ledger and a download log opened on the same database"""
+
+    def __init__(self, folder):
+        db_file = os.path.join(folder, "state.db")
+        self.ledger = InvoiceLedger(db_file, legacy_file=os.path.join(folder, "invoice_links.json"))
+        self.download_log = DownloadLog(db_file, legacy_file=os.path.join(folder, "downloaded_invoices_log.json"))
+
+    def issue(self, invoice_number, series_name=None):
+        self.ledger.add(f"order-{series_name}-{invoice_number}", f"https://stub/pdf/{invoice_number}",
+                        invoice_number, 10.0, series_name=series_name)
+
+    def pending(self):
+        return [(invoice["series_name"], invoice["invoice_number"]) for invoice in self.download_log.pending_invoices()]
+
+    def download(self, invoice_number, series_name=""):
+        self.download_log.add({"timestamp": datetime.now().isoformat(), "series_name": series_name,
+                               "invoice_number": invoice_number, "status": "downloaded"})
+
+    def close(self):
+        self.download_log.close()
+        self.ledger.close()
+
+
+def test_late_lower_number():
+    """A lower number recorded after a higher one was downloaded is still pending"""
+    with tempfile.TemporaryDirectory() as folder:
+        run = Run(folder)
+        run.issue(4102, "AAA")
+        assert run.pending() == [("AAA", "4102")]
+        run.download(4102, "AAA")
+        run.close()
+
+        run = Run(folder)
+        run.issue(4101, "AAA")
+        pending = run.pending()
+        run.close()
+        print(f"   Pending after 4101 was recorded late: {pending}")
+        assert pending == [("AAA", "4101")]
+
+
+def test_same_number_in_two_series():
+    """The same number in AAA and EXT is two invoices: downloading one leaves the other pending"""
+    with tempfile.TemporaryDirectory() as folder:
+        run = Run(folder)
+        run.issue(4100, "AAA")
+        run.issue(4100, "EXT")
+        assert run.pending() == [("AAA", "4100"), ("EXT", "4100")]
+        run.download(4100, "AAA")
+        pending = run.pending()
+        run.close()
+        print(f"   Pending after AAA 4100 was downloaded: {pending}")
+        assert pending == [("EXT", "4100")]
+
+
+def test_failed_download_stays_pending():
+    """An invoice that failed to download stays in the gap set after the watermark moved past it"""
+    with tempfile.TemporaryDirectory() as folder:
+        run = Run(folder)
+        run.issue(4100, "AAA")
+        run.issue(4101, "AAA")
+        assert run.pending() == [("AAA", "4100"), ("AAA", "4101")]
+        run.download(4101, "AAA")
+        run.close()
+
+        for attempt in range(2):
+            run = Run(folder)
+            pending = run.pending()
+            watermark = run.download_log.get_meta(DOWNLOAD_WATERMARK_KEY)
+            run.close()
+            print(f"   Run {attempt + 2}: pending {pending}, watermark at ledger row {watermark}")
+            assert pending == [("AAA", "4100")]
+            assert watermark == "2"
+
+
+def test_legacy_row_without_series():
+    """A ledger row without a series is pending until it is logged without a series"""
+    with tempfile.TemporaryDirectory() as folder:
+        run = Run(folder)
+        run.issue(4050)
+        run.issue(4050, "AAA")
+        assert run.pending() == [(None, "4050"), ("AAA", "4050")]
+        run.download(4050)
+        pending = run.pending()
+        run.close()
+        print(f"   Pending after the legacy 4050 was downloaded: {pending}")
+        assert pending == [("AAA", "4050")]
+
+
+def main():
+    """Run all download log tests"""
+    print("🧪 DOWNLOAD LOG TESTS")
+    print("=" * 60)
+
+    tests = [
+        test_late_lower_number,
+        test_same_number_in_two_series,
+        test_failed_download_stays_pending,
+        test_legacy_row_without_series,
+    ]
+
+    failed = 0
+    for test in tests:
+        print(f"\n🔍 {test.__doc__}")
+        try:
+            test()
+            print("   ✅ PASS")
+        except AssertionError:
+            print("   ❌ FAIL")
+            failed += 1
+
+    print(f"\n{'='*60}")
+    print(f"Passed: {len(tests) - failed}/{len(tests)}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Test script for the --sync paging of Trendyol orders
+Checks iter_modified_orders against a fake orders endpoint without making API calls
+"""
+
+import json
+import os
+import tempfile
+import threading
+import api_clients
+from api_clients import iter_modified_orders
+
+END_DATE = 1000
+
+
+class FakeResponse:
+    """Minimal stand-in for requests.Response"""
+
+    def __init__(self, data):
+        self.data = data
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+
+class FakeOrdersEndpoint:
+    """Shipment packages filtered by startDate/endDate and sorted by lastModifiedDate, like Trendyol"""
+
+    def __init__(self, modified_dates):
+        self.packages = {package_id: modified for package_id, modified in enumerate(modified_dates, 1)}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def fetch_orders_page(self, page, size, extra_params=None):
+        params = extra_params or {}
+        start_date = params.get("startDate") or 0
+        end_date = params.get("endDate", float("inf"))
+        with self.lock:
+            self.requests += 1
+            matching = sorted((modified, package_id) for package_id, modified in self.packages.items()
+                              if start_date <= modified <= end_date)
+        return FakeResponse({"content": [{"shipmentPackageId": package_id, "lastModifiedDate": modified}
+                                         for modified, package_id in matching[page * size:(page + 1) * size]]})
+
+    def link_invoice(self, package_id):
+        """Posting the invoice link moves the package past the end of the sync window"""
+        with self.lock:
+            self.packages[package_id] = END_DATE + 1
+
+
+def run_sync(endpoint, link=True, size=3):
+    """Package ids yielded by one sync run, linking each one as main.py does"""
+    yielded = []
+    for order in iter_modified_orders({"endDate": END_DATE}, size=size):
+        yielded.append(order["shipmentPackageId"])
+        if link:
+            endpoint.link_invoice(order["shipmentPackageId"])
+    return yielded
+
+
+def test_boundary_packages_yielded_once():
+    """Packages sharing the timestamp at a page boundary are yielded once each"""
+    endpoint = FakeOrdersEndpoint([1, 2, 3, 3, 3, 3, 4, 5, 5, 6])
+    api_clients.fetch_orders_page = endpoint.fetch_orders_page
+    yielded = run_sync(endpoint, link=False)
+    print(f"   Yielded {yielded} in {endpoint.requests} requests")
+    assert yielded == list(range(1, 11))
+
+
+def test_full_page_at_one_instant():
+    """More packages than a page modified at one instant are all yielded, also while they are being linked"""
+    for link in (False, True):
+        endpoint = FakeOrdersEndpoint([5] + [10] * 8 + [11, 12])
+        api_clients.fetch_orders_page = endpoint.fetch_orders_page
+        yielded = run_sync(endpoint, link=link)
+        print(f"   {'Linking' if link else 'Not linking'}: yielded {yielded} in {endpoint.requests} requests")
+        assert sorted(yielded) == list(range(1, 12))
+
+
+def test_linked_packages_do_not_shift_pages():
+    """Packages moved past endDate in the middle of the run don't make later packages skipped"""
+    endpoint = FakeOrdersEndpoint([modified // 2 for modified in range(40)])
+    api_clients.fetch_orders_page = endpoint.fetch_orders_page
+    yielded = run_sync(endpoint)
+    print(f"   Yielded {len(yielded)} of 40 packages ({len(set(yielded))} distinct)")
+    assert sorted(yielded) == list(range(1, 41))
+
+
+def test_packages_after_end_date_are_left_out():
+    """Packages modified after endDate are left for the next run"""
+    endpoint = FakeOrdersEndpoint([1, 2, END_DATE, END_DATE + 1, 3])
+    api_clients.fetch_orders_page = endpoint.fetch_orders_page
+    yielded = run_sync(endpoint)
+    print(f"   Yielded {sorted(yielded)}")
+    assert sorted(yielded) == [1, 2, 3, 5]
+
+
+def main():
+    """Run all sync paging tests"""
+    print("🧪 SYNC PAGING TESTS")
+    print("=" * 60)
+
+    tests = [
+        test_boundary_packages_yielded_once,
+        test_full_page_at_one_instant,
+        test_linked_packages_do_not_shift_pages,
+        test_packages_after_end_date_are_left_out,
+    ]
+
+    # iter_modified_orders keeps the first page in orders.json: keep it out of the working folder
+    working_folder = os.getcwd()
+    failed = 0
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            for test in tests:
+                print(f"\n🔍 {test.__doc__}")
+                try:
+                    test()
+                    print("   ✅ PASS")
+                except AssertionError:
+                    print("   ❌ FAIL")
+                    failed += 1
+        finally:
+            os.chdir(working_folder)
+
+    print(f"\n{'='*60}")
+    print(f"Passed: {len(tests) - failed}/{len(tests)}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    main()
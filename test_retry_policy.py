@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Test script for the HTTP retry policy
+Checks Retry-After handling, backoff limits and the retry loop without making API calls
+"""
+
+import time
+from email.utils import formatdate
+import http_client
+from http_client import ApiClient, RetryPolicy
+
+
+class FakeResponse:
+    """Minimal stand-in for requests.Response"""
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Returns the queued responses in order and records how many requests were made"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def test_retry_after_seconds():
+    """Retry-After given in seconds is used as the base of the delay"""
+    policy = RetryPolicy(base_delay=0.5)
+    delay = policy.get_delay(FakeResponse(429, {"Retry-After": "3"}), 1)
+    print(f"   Retry-After: 3 -> {delay:.2f}s")
+    assert 3 <= delay <= 3.5
+
+
+def test_retry_after_is_not_shortened():
+    """A Retry-After longer than max_delay is waited in full, not cut down to max_delay"""
+    policy = RetryPolicy(base_delay=0.5, max_delay=60.0)
+    delay = policy.get_delay(FakeResponse(429, {"Retry-After": "90"}), 1)
+    print(f"   Retry-After: 90 -> {delay:.2f}s")
+    assert 90 <= delay <= 90.5
+
+
+def test_retry_after_http_date():
+    """Retry-After given as an HTTP date is converted to seconds from now"""
+    policy = RetryPolicy()
+    retry_at = formatdate(time.time() + 10, usegmt=True)
+    delay = policy.get_server_delay(FakeResponse(429, {"Retry-After": retry_at}))
+    print(f"   Retry-After: {retry_at} -> {delay:.2f}s")
+    assert 8 <= delay <= 10
+
+
+def test_backoff_is_capped():
+    """Without server hints the backoff grows exponentially but never passes max_delay"""
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    delays = [policy.get_delay(FakeResponse(429), attempt) for attempt in range(1, 10)]
+    print(f"   Backoff delays: {', '.join(f'{delay:.2f}' for delay in delays)}")
+    assert all(0 <= delay <= 5.0 for delay in delays)
+
+
+def test_request_retries_then_succeeds():
+    """A couple of 429s are retried transparently"""
+    client = ApiClient("http://stub", retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.01))
+    client.session = FakeSession([FakeResponse(429), FakeResponse(429), FakeResponse(200)])
+    response = client.request("POST", "/api/docs/invoice")
+    print(f"   Final status: {response.status_code} after {client.session.calls} requests")
+    assert response.status_code == 200
+    assert client.session.calls == 3
+
+
+def test_request_gives_up_after_max_attempts():
+    """Persistent throttling returns the last 429 instead of retrying forever"""
+    client = ApiClient("http://stub", retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01))
+    client.session = FakeSession([FakeResponse(429)] * 5)
+    response = client.request("GET", "/orders")
+    print(f"   Final status: {response.status_code} after {client.session.calls} requests")
+    assert response.status_code == 429
+    assert client.session.calls == 3
+
+
+def test_request_respects_total_delay_cap():
+    """A Retry-After longer than the total budget is not waited for"""
+    client = ApiClient("http://stub", retry_policy=RetryPolicy(max_total_delay=1.0))
+    client.session = FakeSession([FakeResponse(429, {"Retry-After": "30"}), FakeResponse(200)])
+    response = client.request("GET", "/orders")
+    print(f"   Final status: {response.status_code} after {client.session.calls} requests")
+    assert response.status_code == 429
+    assert client.session.calls == 1
+
+
+def main():
+    """Run all retry policy tests"""
+    print("🧪 RETRY POLICY TESTS")
+    print("=" * 60)
+
+    # Keep the rate limiter out of the way of the fake sessions
+    http_client.throttle = lambda url, api=None: None
+
+    tests = [
+        test_retry_after_seconds,
+        test_retry_after_is_not_shortened,
+        test_retry_after_http_date,
+        test_backoff_is_capped,
+        test_request_retries_then_succeeds,
+        test_request_gives_up_after_max_attempts,
+        test_request_respects_total_delay_cap,
+    ]
+
+    failed = 0
+    for test in tests:
+        print(f"\n🔍 {test.__doc__}")
+        try:
+            test()
+            print("   ✅ PASS")
+        except AssertionError:
+            print("   ❌ FAIL")
+            failed += 1
+
+    print(f"\n{'='*60}")
+    print(f"Passed: {len(tests) - failed}/{len(tests)}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    main()